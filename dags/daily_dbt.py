@@ -1,26 +1,53 @@
 from airflow import DAG
 from airflow.operators.bash import BashOperator
-from airflow.models import Variable
+from airflow.operators.python import PythonOperator
 
+import os
 from datetime import datetime, timedelta
 
+from dbt_tasks import (DBT_SELECT_TASK, create_dbt_task_groups, create_other_tests_task, dbt_parse_command, load_manifest,
+                       save_state, select_models)
+from notifications import FAILURE_EMAIL_ARGS
 
-with DAG("DAG_daily_dbt", start_date=datetime(2021, 1, 1), schedule_interval="30 2 * * *", catchup=False) as dag:
-    dbt_run = BashOperator(
-        task_id='dbt_run',
-        bash_command='dbt run --project-dir=/home/airflow/dbt/daily ',
-        email_on_failure=True,
-        execution_timeout=timedelta(seconds=3600),
-        email=Variable.get("mail_zulip"),
+# One task group per model, tag or package of the dbt project
+DBT_GROUP_BY = "model"
+# Airflow pool of the dbt tasks, its slots limit how many dbt commands run at the same time. Read from the
+# environment (AIRFLOW_VAR_DBT_POOL), a Variable here would be a metadata DB query on every parse of the DAG
+DBT_POOL = os.environ.get("AIRFLOW_VAR_DBT_POOL", "default_pool")
+
+
+with DAG("DAG_daily_dbt", start_date=datetime(2021, 1, 1), schedule_interval="30 2 * * *", catchup=False,
+         default_args=FAILURE_EMAIL_ARGS) as dag:
+    # Also writes the manifest the model tasks are built from in the next parse of this DAG
+    dbt_parse = BashOperator(
+        task_id='dbt_parse',
+        bash_command=dbt_parse_command(),
+        dag=dag
+    )
+
+    # Only the models whose code or upstream data changed since the previous run are built
+    dbt_select = PythonOperator(
+        task_id=DBT_SELECT_TASK,
+        python_callable=select_models,
         dag=dag
     )
 
-    dbt_test = BashOperator(
-        task_id='dbt_test',
-        bash_command='dbt test --project-dir=/home/airflow/dbt/daily',
-        email_on_failure=True,
-        email=Variable.get("mail_zulip"),
+    manifest = load_manifest()
+    task_groups = create_dbt_task_groups(manifest, group_by=DBT_GROUP_BY, upstream=dbt_select, pool=DBT_POOL,
+                                         execution_timeout=timedelta(seconds=3600))
+    # Source tests and the tests of models in unrelated groups, that the task groups do not select
+    dbt_test_other = create_other_tests_task(manifest, group_by=DBT_GROUP_BY, pool=DBT_POOL)
+
+    # Also when some model fails, the models that were not built are selected again in the next run
+    dbt_save_state = PythonOperator(
+        task_id='dbt_save_state',
+        python_callable=save_state,
+        trigger_rule="all_done",
         dag=dag
     )
 
-    dbt_run >> dbt_test
+    dbt_parse >> dbt_select
+    for task_group in task_groups.values():
+        task_group >> (dbt_test_other or dbt_save_state)
+    if dbt_test_other is not None:
+        dbt_test_other >> dbt_save_state
@@ -0,0 +1,388 @@
+"""
+Airflow tasks built from the dbt manifest.json: one task group per model (or per tag or package) that runs the
+models and then tests them, wired along the dependencies between the models. A failed model only stops the
+models that depend on it, and clearing it reruns only that part of the graph.
+
+The manifest is written by the dbt_parse task of every run, so new models show up in the DAG after the next run.
+Without a manifest all the models are run and tested in a single group.
+
+Only the models whose code or upstream data changed since the previous run are built: the select_models task
+compares the project with the artifacts saved by save_state at the end of the previous run (state:modified+ and
+source_status:fresher+), and the groups without selected models do nothing. Models that failed or were not built
+in a run are kept as pending and selected again in the next one.
+
+Variables, read when the tasks run:
+- dbt_threads: threads of every dbt command (4 by default)
+- full-refresh: when not empty (--full-refresh) every model is built again, with that flag
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+from collections import defaultdict
+from datetime import timedelta
+
+from airflow.models import Variable
+from airflow.operators.bash import BashOperator
+from airflow.utils.state import State
+from airflow.utils.task_group import TaskGroup
+
+logger = logging.getLogger(__name__)
+
+DBT_PROJECT_DIR = "/home/airflow/dbt/daily"
+# Artifacts of the tasks, every task has its own target path inside it
+DBT_TARGET_DIR = os.path.join(DBT_PROJECT_DIR, "target", "airflow")
+# Written by dbt_parse_command(), the target/manifest.json of dbt can be half written while a task is running
+DBT_MANIFEST = os.path.join(DBT_TARGET_DIR, "manifest.json")
+DBT_PARSE_PATH = os.path.join(DBT_TARGET_DIR, "dbt_parse")
+# Target path of the source freshness and the selection of select_models
+DBT_SELECT_PATH = os.path.join(DBT_TARGET_DIR, "dbt_select")
+# manifest.json, sources.json and run_results.json of the previous run, and the models pending from it
+DBT_STATE_DIR = os.path.join(DBT_TARGET_DIR, "state")
+DBT_PENDING_FILE = os.path.join(DBT_STATE_DIR, "pending.json")
+DBT_THREADS = "{{ var.value.get('dbt_threads', 4) }}"
+DBT_SELECT_TASK = "dbt_select"
+DBT_TEST_OTHER_TASK = "dbt_test_other"
+GROUP_BY = ("model", "tag", "package")
+
+
+def load_manifest(path=DBT_MANIFEST):
+    for manifest_path in (path, os.path.join(DBT_PROJECT_DIR, "target", "manifest.json")):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read the dbt manifest [{manifest_path}]: {e}")
+    return None
+
+
+def get_models(manifest):
+    return {unique_id: node for unique_id, node in manifest["nodes"].items() if node["resource_type"] == "model"}
+
+
+def get_model_groups(manifest, group_by="model"):
+    """
+    Returns the model names of every group, and the groups every group depends on.
+    Models with several tags go in the group of the first one. When the groups of tags or packages depend on each
+    other in a cycle, or two of them get the same task group id, every model gets its own group instead.
+    """
+    if group_by not in GROUP_BY:
+        raise ValueError(f"Unknown dbt grouping: {group_by}. Available: {', '.join(GROUP_BY)}")
+    groups, dependencies = group_models(get_models(manifest), group_by)
+
+    problems = [f"{' and '.join(colliding)} have the same task group id {group_id}"
+                for group_id, colliding in get_group_id_collisions(groups).items()]
+    cycle = find_group_cycle(dependencies)
+    if cycle:
+        problems.append(f"the groups depend on each other in a cycle: {' -> '.join(cycle)}")
+    if problems and group_by != "model":
+        logger.warning(f"The dbt models can not be grouped by {group_by}, {'; '.join(problems)}. "
+                       f"Every model gets its own group")
+        return get_model_groups(manifest, "model")
+    if problems:
+        raise ValueError(f"The dbt models can not be grouped by {group_by}: {'; '.join(problems)}")
+    return groups, dependencies
+
+
+def group_models(models, group_by):
+
+    groups = defaultdict(list)
+    model_groups = {}
+    for unique_id, node in sorted(models.items()):
+        if group_by == "model":
+            group = node["name"]
+        elif group_by == "tag":
+            group = sorted(node.get("tags") or ["untagged"])[0]
+        else:
+            group = node["package_name"]
+        groups[group].append(node["name"])
+        model_groups[unique_id] = group
+
+    dependencies = defaultdict(set)
+    for unique_id, node in models.items():
+        for upstream_id in node.get("depends_on", {}).get("nodes", []):
+            upstream_group = model_groups.get(upstream_id)
+            if upstream_group is not None and upstream_group != model_groups[unique_id]:
+                dependencies[model_groups[unique_id]].add(upstream_group)
+    return dict(groups), dict(dependencies)
+
+
+def get_group_id_collisions(groups):
+    # Groups whose names only differ in the characters that get_group_id replaces, like a.b and a_b
+    names_by_id = defaultdict(list)
+    for group in groups:
+        names_by_id[get_group_id(group)].append(group)
+    return {group_id: sorted(names) for group_id, names in names_by_id.items() if len(names) > 1}
+
+
+def find_group_cycle(dependencies):
+    # The groups of a dependency cycle, starting and ending with the same one, or None. The models never have
+    # cycles, but their tags or packages can: a model of A after one of B, and another of B after one of A
+    visited, path = set(), []
+
+    def visit(group):
+        if group in path:
+            return path[path.index(group):] + [group]
+        if group in visited:
+            return None
+        visited.add(group)
+        path.append(group)
+        for upstream_group in sorted(dependencies.get(group, ())):
+            cycle = visit(upstream_group)
+            if cycle:
+                return cycle
+        path.pop()
+        return None
+
+    for group in sorted(dependencies):
+        cycle = visit(group)
+        if cycle:
+            return cycle
+    return None
+
+
+def get_model_ancestors(models):
+    # Models upstream of every model, directly or through other models
+    ancestors = {}
+
+    def visit(unique_id):
+        if unique_id not in ancestors:
+            ancestors[unique_id] = set()
+            for upstream_id in models[unique_id].get("depends_on", {}).get("nodes", []):
+                if upstream_id in models:
+                    ancestors[unique_id] |= {upstream_id} | visit(upstream_id)
+        return ancestors[unique_id]
+
+    for unique_id in models:
+        visit(unique_id)
+    return ancestors
+
+
+def get_other_tests(manifest, groups):
+    """
+    Names of the tests the test task of no group runs: the ones on sources, seeds or snapshots, the ones without
+    parents and the ones whose models are in groups that do not depend on each other. A test is run by a group
+    when all its parents are models of the group or upstream of them (--indirect-selection=buildable).
+    """
+    models = get_models(manifest)
+    ancestors = get_model_ancestors(models)
+    ids_by_name = {node["name"]: unique_id for unique_id, node in models.items()}
+    group_ids = []
+    for group_models in groups.values():
+        ids = {ids_by_name[name] for name in group_models if name in ids_by_name}
+        group_ids.append(ids.union(*(ancestors[unique_id] for unique_id in ids)))
+
+    tests = set()
+    for node in manifest["nodes"].values():
+        if node["resource_type"] != "test":
+            continue
+        parents = set(node.get("depends_on", {}).get("nodes", []))
+        if not parents or not parents <= set(models) or not any(parents <= ids for ids in group_ids):
+            tests.add(node["name"])
+    return sorted(tests)
+
+
+def dbt_command(command):
+    """
+    Runs or tests the models of the task group (params.models) that were selected by select_models, and all of
+    them when there is no selection. Without selected models in the group it does nothing.
+    """
+    # Every task writes to its own target path, dbt commands running at the same time would overwrite their files
+    bash_command = (f"dbt {command} --project-dir={DBT_PROJECT_DIR} --target-path={DBT_TARGET_DIR}/{{{{ ti.task_id }}}} "
+                    f"--threads {DBT_THREADS}")
+    bash_command += "{% if models %} --select {{ models | join(' ') }}"
+    if command == "test":
+        # Only the tests whose models are all selected or already built upstream, the rest run with their
+        # last model
+        bash_command += " --indirect-selection=buildable"
+    bash_command += "{% endif %}"
+    if command == "run":
+        bash_command += " {{ var.value.get('full-refresh', '') }}"
+    return (
+        "{% set selected = ti.xcom_pull(task_ids='" + DBT_SELECT_TASK + "') %}"
+        "{% if selected is none %}{% set models = params.models %}"
+        "{% elif params.models is none %}{% set models = selected %}"
+        "{% else %}{% set models = params.models | select('in', selected) | list %}{% endif %}"
+        "{% if models is none or models %}" + bash_command + "{% else %}echo 'No models selected in this group'{% endif %}"
+    )
+
+
+def dbt_parse_command():
+    # The manifest for the next parse of the DAG is replaced at once, so it is never read half written
+    return (f"dbt parse --project-dir={DBT_PROJECT_DIR} --target-path={DBT_PARSE_PATH} && "
+            f"cp {DBT_PARSE_PATH}/manifest.json {DBT_MANIFEST}.tmp && mv {DBT_MANIFEST}.tmp {DBT_MANIFEST}")
+
+
+def run_dbt(*args, check=False):
+    result = subprocess.run(["dbt", *args, f"--project-dir={DBT_PROJECT_DIR}"], capture_output=True, text=True)
+    for line in (result.stdout + result.stderr).splitlines():
+        logger.info(line)
+    if check and result.returncode != 0:
+        raise RuntimeError(f"dbt {' '.join(args)} failed with exit code {result.returncode}")
+    return result
+
+
+def load_pending():
+    try:
+        with open(DBT_PENDING_FILE, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return []
+
+
+def select_models():
+    """
+    Names of the models to build in this run, pushed to XCom for the model tasks. None builds all of them.
+    """
+    manifest = load_manifest(os.path.join(DBT_PARSE_PATH, "manifest.json"))
+    model_names = {node["name"] for node in get_models(manifest).values()} if manifest is not None else set()
+
+    # The freshness is saved with the state even when it is not used, so the next run can compare with it
+    sources_path = os.path.join(DBT_SELECT_PATH, "sources.json")
+    if os.path.isfile(sources_path):
+        os.remove(sources_path)
+    # Exits with an error when a source is stale, the freshness of the rest is still written
+    run_dbt("source", "freshness", f"--target-path={DBT_SELECT_PATH}")
+
+    full_refresh = Variable.get("full-refresh", default_var="").strip()
+    if full_refresh:
+        logger.info(f"Full refresh ({full_refresh}): all the {len(model_names)} models are built")
+        return None
+    if not os.path.isfile(os.path.join(DBT_STATE_DIR, "manifest.json")):
+        logger.info(f"No previous state in [{DBT_STATE_DIR}]: all the {len(model_names)} models are built")
+        return None
+
+    selectors = ["state:modified+"]
+    if os.path.isfile(sources_path) and os.path.isfile(os.path.join(DBT_STATE_DIR, "sources.json")):
+        selectors.append("source_status:fresher+")
+    pending = sorted(model for model in load_pending() if model in model_names)
+    selectors.extend(f"{model}+" for model in pending)
+
+    result = run_dbt("--quiet", "ls", "--resource-type", "model", "--output", "name", "--select", *selectors,
+                     f"--state={DBT_STATE_DIR}", f"--target-path={DBT_SELECT_PATH}", check=True)
+    selected = sorted(set(result.stdout.split()))
+    logger.info(f"dbt selection: {' '.join(selectors[:2])}" + (f" and {len(pending)} pending models" if pending else ""))
+    logger.info(f"{len(selected)} models selected, {len(model_names) - len(selected)} of {len(model_names)} skipped")
+    return selected
+
+
+def save_state(ti, dag, dag_run):
+    """
+    Saves the artifacts of this run as the state the next run is compared with. Models that were selected but
+    not built and tested are kept as pending, so they are built in the next run even if nothing changed.
+    """
+    selected = ti.xcom_pull(task_ids=DBT_SELECT_TASK)
+    manifest = load_manifest(os.path.join(DBT_PARSE_PATH, "manifest.json"))
+    all_models = sorted({node["name"] for node in get_models(manifest).values()}) if manifest is not None else []
+
+    group_states = defaultdict(list)
+    group_models = {}
+    for task_instance in dag_run.get_task_instances():
+        group_id, _, task_name = task_instance.task_id.rpartition(".")
+        if group_id and task_name in ("run", "test"):
+            group_states[group_id].append(task_instance.state)
+            group_models[group_id] = dag.get_task(task_instance.task_id).params.get("models") or all_models
+
+    built, not_built = set(), set()
+    for group_id, states in group_states.items():
+        models = [model for model in group_models[group_id] if selected is None or model in selected]
+        if all(state == State.SUCCESS for state in states):
+            built.update(models)
+        else:
+            not_built.update(models)
+    pending = sorted((set(load_pending()) | not_built) - built)
+
+    os.makedirs(DBT_STATE_DIR, exist_ok=True)
+    for source_dir, filename in ((DBT_PARSE_PATH, "manifest.json"), (DBT_SELECT_PATH, "sources.json")):
+        if os.path.isfile(os.path.join(source_dir, filename)):
+            shutil.copy2(os.path.join(source_dir, filename), os.path.join(DBT_STATE_DIR, filename))
+    save_run_results(dag_run)
+    with open(DBT_PENDING_FILE, "w", encoding="utf-8") as file:
+        json.dump(pending, file)
+    logger.info(f"{len(built)} models built and tested, {len(pending)} pending for the next run")
+
+
+def save_run_results(dag_run):
+    # run_results.json of every dbt task of this run in one file. Tasks that did nothing keep an older file
+    run_results = None
+    for task_instance in dag_run.get_task_instances():
+        path = os.path.join(DBT_TARGET_DIR, task_instance.task_id, "run_results.json")
+        if task_instance.start_date is None or not os.path.isfile(path) or \
+                os.path.getmtime(path) < task_instance.start_date.timestamp():
+            continue
+        with open(path, "r", encoding="utf-8") as file:
+            task_results = json.load(file)
+        if run_results is None:
+            run_results = task_results
+        else:
+            run_results["results"].extend(task_results["results"])
+    if run_results is not None:
+        with open(os.path.join(DBT_STATE_DIR, "run_results.json"), "w", encoding="utf-8") as file:
+            json.dump(run_results, file)
+
+
+def get_group_id(group):
+    return re.sub(r"[^\w-]", "_", group)
+
+
+def create_dbt_task_groups(manifest, group_by="model", upstream=None, pool=None,
+                           execution_timeout=timedelta(seconds=3600)):
+    """
+    Creates a run and a test task for every group of models, inside the current DAG. The groups without
+    dependencies go after upstream. Returns the task groups by group name.
+    """
+    if manifest is None:
+        groups, dependencies = {"dbt": None}, {}
+    else:
+        groups, dependencies = get_model_groups(manifest, group_by)
+
+    task_groups = {}
+    for group, models in groups.items():
+        with TaskGroup(group_id=get_group_id(group)) as task_group:
+            dbt_run = BashOperator(
+                task_id="run",
+                bash_command=dbt_command("run"),
+                params={"models": models},
+                execution_timeout=execution_timeout,
+                pool=pool,
+            )
+            dbt_test = BashOperator(
+                task_id="test",
+                bash_command=dbt_command("test"),
+                params={"models": models},
+                pool=pool,
+            )
+            dbt_run >> dbt_test
+        task_groups[group] = task_group
+
+    for group, task_group in task_groups.items():
+        upstream_groups = dependencies.get(group)
+        if upstream_groups:
+            for upstream_group in sorted(upstream_groups):
+                task_groups[upstream_group] >> task_group
+        elif upstream is not None:
+            upstream >> task_group
+    return task_groups
+
+
+def create_other_tests_task(manifest, group_by="model", pool=None):
+    """
+    Creates a task for the tests that no task group runs (get_other_tests), like the source tests, inside the
+    current DAG. Returns None when there are none, or without a manifest, as the single group runs every test then.
+    It runs when the task groups are done, even if some of them failed, so the source tests always run.
+    """
+    if manifest is None:
+        return None
+    groups, _ = get_model_groups(manifest, group_by)
+    other_tests = get_other_tests(manifest, groups)
+    if not other_tests:
+        return None
+    return BashOperator(
+        task_id=DBT_TEST_OTHER_TASK,
+        bash_command=f"dbt test --project-dir={DBT_PROJECT_DIR} --target-path={DBT_TARGET_DIR}/{DBT_TEST_OTHER_TASK} "
+                     f"--threads {DBT_THREADS} --select {' '.join(other_tests)}",
+        trigger_rule="all_done",
+        pool=pool,
+    )
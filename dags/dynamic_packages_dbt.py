@@ -1,18 +1,21 @@
 from airflow import DAG
 from airflow.operators.bash import BashOperator
-from airflow.models import Variable
 
 from datetime import datetime
 
+from dbt_tasks import DBT_PROJECT_DIR, DBT_THREADS
+from notifications import FAILURE_EMAIL_ARGS
 
-with DAG("DAG_dynamic_packages_dbt", start_date=datetime(2021, 1, 1), schedule_interval=None, catchup=False) as dag:
-    dbt_run = BashOperator(
-        task_id='dbt_run',
-        bash_command='dbt run --project-dir=/home/airflow/dbt/daily --select ' +
-                     Variable.get("packages_dbt")+ ' '+Variable.get("full-refresh"),
-        email_on_failure=True,
-        email=Variable.get("mail_zulip"),
+
+with DAG("DAG_dynamic_packages_dbt", start_date=datetime(2021, 1, 1), schedule_interval=None, catchup=False,
+         default_args=FAILURE_EMAIL_ARGS) as dag:
+    # The selection is only known when the DAG runs, dbt build runs the selected models in dependency order
+    # and tests every model right after it is built, skipping the models downstream of a failure
+    dbt_build = BashOperator(
+        task_id='dbt_build',
+        bash_command=f'dbt build --project-dir={DBT_PROJECT_DIR} --threads {DBT_THREADS} '
+                     '--select {{ var.value.packages_dbt }} {{ var.value.get("full-refresh", "") }}',
         dag=dag
     )
 
-    dbt_run
+    dbt_build
@@ -6,129 +6,254 @@ from airflow.models import Variable
 from airflow.exceptions import AirflowSkipException
 
 import os
-import paramiko
+import csv
+import functools
+import shutil
+import contextlib
 import stat
+from collections import namedtuple
 import logging
 logger = logging.getLogger(__name__)
 
 from datetime import datetime
 
-SFTP_ROOT = Variable.get("sftp_root")
+from notifications import FAILURE_EMAIL_ARGS
+from sftp_transfer import SftpTransfer, StreamingUpload
 
-def get_sftp_client():
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(Variable.get("sftp_host"), Variable.get("sftp_port"),
-                Variable.get("sftp_user"), Variable.get("sftp_password"))
-    return ssh.open_sftp()
+# Remote directory with the latest version of every infographic, only used in incremental mode
+CURRENT_DIR = "infografias"
+
+# Mapped tasks at the same time. Read from the environment (AIRFLOW_VAR_INFOGRAFIAS_MAX_PARALLEL_TASKS), the
+# scheduler parses this file constantly and a Variable here would be a metadata DB query on every parse
+MAX_PARALLEL_TASKS = int(os.environ.get("AIRFLOW_VAR_INFOGRAFIAS_MAX_PARALLEL_TASKS", 4))
+
+SftpConfig = namedtuple("SftpConfig", ["host", "port", "user", "password", "root", "channels"])
+
+@functools.lru_cache(maxsize=None)
+def get_sftp_config():
+    # Read once per task when it runs, every connection of the task uses the same values
+    return SftpConfig(Variable.get("sftp_host"), Variable.get("sftp_port"), Variable.get("sftp_user"),
+                      Variable.get("sftp_password"), Variable.get("sftp_root"),
+                      int(Variable.get("sftp_channels", default_var=4)))
+
+def get_sftp_root():
+    return get_sftp_config().root
+
+def get_sftp_transfer():
+    config = get_sftp_config()
+    return SftpTransfer(config.host, config.port, config.user, config.password, channels=config.channels)
+
+def add_transfer_metrics(metrics, transfer):
+    for operation, size, elapsed in transfer.file_times:
+        metrics.add_time(f"sftp_{operation}", elapsed)
+        metrics.count(f"sftp_{operation}_bytes", size)
 
 def begin(ti, logical_date):
     dt = logical_date.in_tz("Europe/Madrid").format("YYYY-MM-DD_HH-mm-ss")
-    tmp_dir = os.path.join(os.sep, "tmp", "infografias", dt)
-    os.makedirs(tmp_dir, exist_ok=True)
-    logger.info(f"Created tempdir at {tmp_dir}")
     ti.xcom_push(key="execution_datetime", value=dt)
-    ti.xcom_push(key="tmp_dir", value=tmp_dir)
-    sftp_client = get_sftp_client()
+    sftp_root = get_sftp_root()
+    from geninfografia.generar_infografias import build_assets
+    from geninfografia.utils.metrics import metrics
+    # CSS and translations are built once here, the mapped tasks would otherwise all build them at the same time
+    build_assets()
+    with metrics.stage("sftp_begin"), get_sftp_transfer() as transfer:
+        files = transfer.sftp.listdir(sftp_root)
+        data_files = [file for file in files if file.split(".")[-1] == "csv"]
 
-    files = sftp_client.listdir(SFTP_ROOT)
-    data_files = [file for file in files if file.split(".")[-1] == "csv"]
+        if not data_files:
+            raise AirflowSkipException
 
-    if not data_files:
-        raise AirflowSkipException
+        move_dirs_to_historic(transfer.sftp)
+        transfer.makedirs(os.path.join(sftp_root, dt))
+        # The static files are the same for every territory, they are uploaded once here instead of by every task
+        upload_static_files(transfer, os.path.join(sftp_root, CURRENT_DIR if is_incremental() else dt))
+        add_transfer_metrics(metrics, transfer)
+    ti.xcom_push(key="data_files", value=data_files)
+    metrics.log_summary()
 
-    move_dirs_to_historic(sftp_client)
+def upload_static_files(transfer, remote_dir):
+    from geninfografia.generar_infografias import ROOT_DIR, get_static_files
+    static_dir = os.path.join(ROOT_DIR, "static")
+    transfer.upload_files([(os.path.join(static_dir, path), os.path.join(remote_dir, "html", "static", path))
+                           for path, _ in get_static_files()])
 
-    for file in data_files:
-        sftp_client.get(os.path.join(SFTP_ROOT, file), os.path.join(tmp_dir, file))
+def get_work_units(ti):
+    # One unit per data file and territory with entities in it, each one is generated by its own mapped task
+    execution_datetime = ti.xcom_pull(key="execution_datetime")
+    data_files = ti.xcom_pull(key="data_files")
+    sftp_root = get_sftp_root()
+
+    from geninfografia.generar_infografias import get_custom_props
+    from geninfografia.utils.parser import Parser
+    known_territories = Parser().parse_territories()
+    selected_territories = get_custom_props()["TERRITORIOS"]
+
+    work_units = []
+    with get_sftp_transfer() as transfer:
+        for data_file in data_files:
+            # Only the header is read, the entity columns are named after their territory code ("And", "And.1", ...)
+            with transfer.sftp.open(os.path.join(sftp_root, data_file), "rb") as file:
+                header = next(csv.reader([file.readline().decode("utf-8")]))
+            territories = {column.split(".")[0] for column in header[4:]}
+            territories = sorted(territory.upper() for territory in territories if territory in known_territories)
+            for territory in territories:
+                if not selected_territories or territory in selected_territories:
+                    work_units.append({"data_file": data_file, "territory": territory,
+                                       "execution_datetime": execution_datetime})
+
+    logger.info(f"{len(work_units)} work units: " +
+                ", ".join(f"{unit['data_file']} {unit['territory']}" for unit in work_units))
+    return work_units
 
 def move_dirs_to_historic(sftp_client):
     # Move previous runs directories to historic folder
     historic_dir = "historico"
-    historic_dir_path = os.path.join(SFTP_ROOT, historic_dir)
+    sftp_root = get_sftp_root()
+    historic_dir_path = os.path.join(sftp_root, historic_dir)
     try:
         sftp_client.stat(historic_dir_path)
     except FileNotFoundError:
         # Create dir if not exists
         sftp_client.mkdir(historic_dir_path)
 
-    for filename in sftp_client.listdir(SFTP_ROOT):
+    # listdir_attr returns the file modes in the same round-trip as the listing
+    for file_attr in sftp_client.listdir_attr(sftp_root):
+        filename = file_attr.filename
         logger.info(f"Trying to move '{filename}' to historic dir.")
-        file_abs_path = os.path.join(SFTP_ROOT, filename)
-        if stat.S_ISDIR(sftp_client.stat(file_abs_path).st_mode) and filename != historic_dir:
+        file_abs_path = os.path.join(sftp_root, filename)
+        if stat.S_ISDIR(file_attr.st_mode) and filename not in (historic_dir, CURRENT_DIR):
             # Move all directories inside the historic_dir
             logger.info(f"Moving directory {filename} to directory '{historic_dir}'")
             sftp_client.rename(file_abs_path, os.path.join(historic_dir_path, filename))
 
-def geninfo(tmp_dir_name):
-    selenium_host = Variable.get("selenium_host")
-    selenium_port = Variable.get("selenium_port")
+@functools.lru_cache(maxsize=None)
+def is_incremental():
+    # In incremental mode the outputs are kept between runs and only the changed ones are generated and uploaded
+    return Variable.get("infografias_incremental", default_var="false").lower() == "true"
+
+def is_streaming():
+    # In streaming mode every infographic is uploaded and deleted from the local disk as soon as it is exported.
+    # The uploads overlap with the export, the HTML files (the smallest outputs) are all rendered before it starts
+    return Variable.get("infografias_streaming", default_var="false").lower() == "true"
+
+def get_output_dir():
+    return Variable.get("infografias_output_dir", default_var=os.path.join(os.sep, "tmp", "infografias", CURRENT_DIR))
+
+def geninfo(ti, data_file, territory, execution_datetime):
+    # Only needed by the selenium backend, the ones that are not set keep the defaults of run
+    selenium_args = {name: Variable.get(name, default_var=None)
+                     for name in ("selenium_host", "selenium_port", "selenium_workers")}
+    selenium_args = {name: value for name, value in selenium_args.items() if value is not None}
+    incremental = is_incremental()
+    sftp_root = get_sftp_root()
+    execution_dir = os.path.join(sftp_root, execution_datetime)
+
+    # Every mapped task works in its own directory, it can run in any worker
+    work_dir = os.path.join(os.sep, "tmp", "infografias", execution_datetime, f"{os.path.splitext(data_file)[0]}_{territory}")
+    os.makedirs(work_dir, exist_ok=True)
+    logger.info(f"Created tempdir at {work_dir}")
+    # In incremental mode the output dir has to be on storage shared by all the workers
+    output_dir = get_output_dir() if incremental else work_dir
 
     from geninfografia import generar_infografias
-    data_files = [file for file in  os.listdir(tmp_dir_name) if file.split(".")[-1] == "csv"]
-    for file in data_files:
-        data_file = os.path.join(tmp_dir_name, file)
-        logger.info(f"Iniciando script para generar infografías a partir del fichero de datos: {data_file}")
-        generar_infografias.run(data_file, tmp_dir_name, regenerate=True, selenium_host=selenium_host, selenium_port=selenium_port)
+    from geninfografia.utils.metrics import metrics
+
+    streaming = is_streaming()
+    if streaming and incremental:
+        # The incremental outputs are kept between runs, they can not be deleted once uploaded
+        logger.warning("Streaming mode is not available in incremental mode, the outputs will be uploaded at the end")
+        streaming = False
+    if streaming and generar_infografias.get_bundle_formats():
+        # The bundles are built from the exported files, they have to stay on disk until the end
+        logger.warning("Streaming mode is not available with BUNDLES, the outputs will be uploaded at the end")
+        streaming = False
+    with get_sftp_transfer() as transfer:
+        local_data_file = os.path.join(work_dir, data_file)
+        with metrics.stage("sftp_download"):
+            transfer.download_files([(os.path.join(sftp_root, data_file), local_data_file)])
+
+        with contextlib.ExitStack() as stack:
+            on_exported = None
+            if streaming:
+                upload = stack.enter_context(StreamingUpload(transfer, work_dir, execution_dir))
+                on_exported = upload.put_files
+
+            logger.info(f"Iniciando script para generar infografías del territorio {territory} a partir del fichero de "
+                        f"datos: {local_data_file}")
+            changed_outputs = generar_infografias.run(local_data_file, output_dir, regenerate=not incremental,
+                                                      incremental=incremental, on_exported=on_exported,
+                                                      territories=[territory], **selenium_args)
+
+        if incremental:
+            # Also the outputs of previous runs whose upload failed, they are only removed from the manifest
+            # pending uploads once they are on the server
+            logger.info(f"{len(changed_outputs)} ficheros han cambiado desde la última ejecución o no se han subido")
+            remote_dir = os.path.join(sftp_root, CURRENT_DIR)
+            uploads = [output for output in changed_outputs if os.path.isfile(os.path.join(output_dir, output))]
+            with metrics.stage("sftp_upload"):
+                transfer.upload_files([(os.path.join(output_dir, output), os.path.join(remote_dir, output))
+                                       for output in uploads])
+            generar_infografias.get_manifest(output_dir, data_file, [territory]).remove_pending(changed_outputs)
+        else:
+            # The static files were uploaded by begin. In streaming mode only the metrics file is left
+            os.remove(local_data_file)
+            shutil.rmtree(os.path.join(work_dir, "html", "static"), ignore_errors=True)
+            with metrics.stage("sftp_upload"):
+                transfer.upload_tree(work_dir, execution_dir)
+        add_transfer_metrics(metrics, transfer)
+    shutil.rmtree(work_dir)
+
+    metrics.log_summary()
+    ti.xcom_push(key="metrics", value=metrics.summary())
+    return len(changed_outputs or [])
 
 def end(ti):
     execution_datetime = ti.xcom_pull(key="execution_datetime")
-    execution_dir = os.path.join(SFTP_ROOT, execution_datetime)
-    sftp_client = get_sftp_client()
-    sftp_client.mkdir(execution_dir)
-
-    tmp_dir = ti.xcom_pull(key="tmp_dir")
-    for (root, dirs, files) in os.walk(tmp_dir, topdown=True):
-        parent_dir = os.path.join(execution_dir, os.path.relpath(root, tmp_dir))
-        for dir in dirs:
-            logger.info(f"Creating directory at [{os.path.join(parent_dir, dir)}]")
-            sftp_client.mkdir(os.path.join(parent_dir, dir))
-
-        for file in files:
-            local_path = os.path.join(root, file)
-            remote_path = os.path.join(parent_dir, file)
-            logger.info(f"Sending file from [{local_path}] to [{remote_path}]")
-            sftp_client.put(local_path, remote_path)
-
-    # Cleanup
-    cleanup(sftp_client, SFTP_ROOT)
-
-def cleanup(sftp_client, remote_root):
-    # Delete root .csv files. As they have been moved to the specific execution directory
-    for file in sftp_client.listdir(remote_root):
-        extension = file.split(".")[-1]
-        if extension == "csv":
-            sftp_client.remove(os.path.join(remote_root, file))
+    sftp_root = get_sftp_root()
+    execution_dir = os.path.join(sftp_root, execution_datetime)
+    changed_outputs = ti.xcom_pull(task_ids="generar_infografias")
+    if changed_outputs and is_incremental():
+        logger.info(f"{sum(changed_outputs)} ficheros han cambiado desde la última ejecución")
+
+    from geninfografia.utils.metrics import merge_summaries, metrics
+    with metrics.stage("sftp_end"), get_sftp_transfer() as transfer:
+        # The data files are moved into the execution directory, as they have already been used
+        for file in ti.xcom_pull(key="data_files"):
+            transfer.sftp.rename(os.path.join(sftp_root, file), os.path.join(execution_dir, file))
 
+    # Totals of the whole run, the percentiles are the worst ones of all the territories
+    summary = merge_summaries(list(ti.xcom_pull(task_ids="generar_infografias", key="metrics") or []) + [metrics.summary()])
+    logger.info("Metrics of the whole run:")
+    metrics.log_summary(summary)
+    ti.xcom_push(key="metrics", value=summary)
 
 with DAG("generate_infographics",
          start_date=datetime(2021, 1, 1),
          schedule_interval="0 6 * * *",
-         catchup=False) as dag:
+         catchup=False,
+         default_args=FAILURE_EMAIL_ARGS) as dag:
 
     begin = PythonOperator(
         task_id="begin",
         python_callable=begin,
-        email_on_failure=True,
-        email=Variable.get("mail_zulip"),
     )
 
-    generar_infografias = PythonOperator(
+    work_units = PythonOperator(
+        task_id="get_work_units",
+        python_callable=get_work_units,
+    )
+
+    # One task per data file and territory, a failure only reruns its own territory
+    generar_infografias = PythonOperator.partial(
         task_id="generar_infografias",
         python_callable=geninfo,
-        op_kwargs = {
-            "tmp_dir_name": "{{ ti.xcom_pull(key='tmp_dir') }}"
-        },
-        email_on_failure=True,
-        email=Variable.get("mail_zulip"),
-    )
+        max_active_tis_per_dag=MAX_PARALLEL_TASKS,
+    ).expand(op_kwargs=work_units.output)
 
     end = PythonOperator(
         task_id="end",
         python_callable=end,
-        email_on_failure=True,
-        email=Variable.get("mail_zulip"),
     )
 
-    begin >> generar_infografias >> end
+    begin >> work_units >> generar_infografias >> end
 
@@ -0,0 +1,270 @@
+"""
+Benchmark of the infographic pipeline with synthetic data, so its performance can be measured without the
+production data sheets.
+
+    python -m geninfografia.benchmark --sizes 100,1000,10000 --export stub --output benchmark.json
+
+Run it from the dags directory. For every size a synthetic data sheet is generated, parsed, rendered to HTML and,
+unless --export none, exported with a stub backend (no browser) or with selenium. The results are written as JSON
+and, with --baseline, compared with a previous result: the exit code is 1 when a stage is slower than the
+baseline by more than --tolerance.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from PIL import Image, ImageDraw
+
+from . import generar_infografias
+from .utils.backends import ExportBackend, save_images
+from .utils.metrics import metrics
+from .utils.parser import Parser
+
+# Languages of the territories with their own language, the rest only use CAS
+TERRITORY_LANGS = {"Cat": "cas;cat", "Val": "cas;cat", "Bal": "cas;cat", "Eus": "cas;eus", "Nav": "cas;eus",
+                   "Gal": "cas;gal"}
+
+
+def get_territory_codes():
+    return list(Parser().parse_territories())
+
+
+def synthetic_value(prop, rng):
+    if prop in Parser.int_properties or prop in Parser.float_properties:
+        kind = rng.random()
+        if kind < 0.1:
+            return ""
+        if kind < 0.4:
+            # Percentage
+            return f"{rng.uniform(0, 100):.1f}".replace(".", ",")
+        # Amount with thousands separators, from units to millions
+        return f"{rng.randint(0, 10 ** rng.randint(1, 8)):,}".replace(",", ".")
+    if prop in Parser.boolean_properties:
+        return rng.choice(["Si", "No", "Si", ""])
+    if prop in Parser.combined_properties:
+        return rng.choice([str(rng.randint(1, 500)), "Cooperativa", "Asociación"])
+    return ""
+
+
+def generate_csv(path, entities, territories=None, seed=0):
+    """
+    Data sheet in the format of Parser.parse_infografias: one row per property and one column per entity, named
+    after the territory code of the entity. Every registered property gets a random value.
+    """
+    rng = random.Random(seed)
+    territories = territories or get_territory_codes()
+    entity_territories = [territories[index % len(territories)] for index in range(entities)]
+    props = sorted(Parser.int_properties | Parser.float_properties | Parser.boolean_properties |
+                   Parser.combined_properties)
+
+    rows = []
+    info = {
+        "Nombre": lambda index, territory: f"Entidad sintética {index}",
+        "NIF": lambda index, territory: f"B{index:08d}",
+        "Idioma": lambda index, territory: TERRITORY_LANGS.get(territory, "cas"),
+        "auditoria/balance": lambda index, territory: "Bal" if index % 3 else "Aud",
+        "Logo": lambda index, territory: "https://example.org/logo.png",
+        "Público?": lambda index, territory: "Si",
+        "Correo electrónico": lambda index, territory: f"entidad{index}@example.org",
+        "código entidad": lambda index, territory: str(index),
+    }
+    for prop, value in info.items():
+        rows.append([prop, prop, "", ""] + [value(index, territory) for index, territory in enumerate(entity_territories)])
+    for prop in props:
+        rows.append([prop, prop, "", ""] + [synthetic_value(prop, rng) for _ in entity_territories])
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["Código", "Codigo Territorio", "titulo de la lista", "titulo del gráfico"] + entity_territories)
+        writer.writerows(rows)
+    return path
+
+
+class StubBackend(ExportBackend):
+    """
+    Export backend without a browser. It reads the HTML and saves a fixed screenshot, so the export workers,
+    the manifest and the disk writes are measured. With images=True the screenshot goes through the same
+    pngquant and PDF steps as the selenium backend.
+    """
+
+    name = "stub"
+
+    def __init__(self, pngquant_path=None, images=False, size=(2480, 3508)):
+        super().__init__(pngquant_path)
+        self.images = images
+        image = Image.new("RGB", size, "white")
+        draw = ImageDraw.Draw(image)
+        for x in range(0, size[0], size[0] // 12):
+            draw.rectangle([x, size[1] // 4, x + size[0] // 24, size[1] // 2], fill=(133, 178, 61))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        self.png_data = buffer.getvalue()
+        buffer = io.BytesIO()
+        image.save(buffer, format="PDF")
+        self.pdf_data = buffer.getvalue()
+
+    def export(self, session, input_file, filename, png_dir, pdf_dir, regenerate=False, percent=0, on_done=None,
+               rendition_paths=()):
+        with open(input_file, "rb") as html_file:
+            html_file.read()
+        png_path = f"{png_dir}/{filename}.png"
+        pdf_path = f"{pdf_dir}/{filename}.pdf"
+        if self.images:
+            save_images(self.png_data, png_path, pdf_path, percent, self.pngquant_path)
+        else:
+            for path, data in ((png_path, self.png_data), (pdf_path, self.pdf_data)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as output_file:
+                    output_file.write(data)
+        if on_done is not None:
+            on_done()
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def stage_result(stage, entities, seconds):
+    return {"stage": stage, "entities": entities, "seconds": round(seconds, 4),
+            "per_entity_ms": round(1000 * seconds / entities, 4) if entities else 0,
+            "per_second": round(entities / seconds, 2) if seconds else 0}
+
+
+def run_benchmark(size, work_dir, args):
+    metrics.reset()
+    data_file = generate_csv(os.path.join(work_dir, f"datos {args.mode}.csv"), size, seed=args.seed)
+    output_path = os.path.join(work_dir, "infografias")
+    results = []
+
+    entities, seconds = timed(Parser().parse_infografias, data_file)
+    results.append(stage_result("parse", len(entities), seconds))
+
+    _, seconds = timed(generar_infografias.generar_infografias, output_path, args.mode, entities, regenerate=True,
+                       workers=args.render_workers)
+    html_files = sum(len(files) for _, _, files in os.walk(os.path.join(output_path, "html")))
+    results.append(stage_result("render", html_files, seconds))
+
+    if args.export != "none":
+        generar_infografias.copy_static_files(output_path)
+        if args.export == "stub":
+            backend = StubBackend(generar_infografias.get_custom_props().get("PNGQUANT_PATH"), images=args.stub_images)
+        else:
+            backend = generar_infografias.get_export_backend(args.selenium_host, args.selenium_port)
+        _, seconds = timed(generar_infografias.exportar_infografias, output_path, None, True, args.selenium_host,
+                           args.selenium_port, workers=args.export_workers, backend=backend)
+        results.append(stage_result(f"export_{args.export}", html_files, seconds))
+
+    return {"size": size, "results": results, "metrics": metrics.summary()}
+
+
+def measure_import_time(module="geninfografia.generar_infografias"):
+    # In a new interpreter, so the modules already imported by the benchmark are not counted
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare_with_baseline(report, baseline, tolerance):
+    # Stages slower than the baseline per entity by more than tolerance (0.2 = 20%)
+    baseline_results = {(run["size"], result["stage"]): result
+                        for run in baseline["runs"] for result in run["results"]}
+    regressions = []
+    previous = baseline.get("import_seconds")
+    if previous and report["import_seconds"] / previous > 1 + tolerance:
+        regressions.append(f"import: {previous:.3f}s -> {report['import_seconds']:.3f}s "
+                           f"({report['import_seconds'] / previous:.2f}x)")
+    for run in report["runs"]:
+        for result in run["results"]:
+            previous = baseline_results.get((run["size"], result["stage"]))
+            if not previous or not previous["per_entity_ms"]:
+                continue
+            ratio = result["per_entity_ms"] / previous["per_entity_ms"]
+            if ratio > 1 + tolerance:
+                regressions.append(f"{result['stage']} con {run['size']} entidades: {previous['per_entity_ms']}ms -> "
+                                   f"{result['per_entity_ms']}ms por entidad ({ratio:.2f}x)")
+    return regressions
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del generador de infografías con datos sintéticos")
+    parser.add_argument("--sizes", default="100,1000,10000", help="Número de entidades de cada ejecución")
+    parser.add_argument("--mode", default="entidades", choices=["entidades", "autonomas"])
+    parser.add_argument("--export", default="stub", choices=["none", "stub", "selenium"])
+    parser.add_argument("--stub-images", action="store_true", help="Optimizar los PNG y generar los PDF con el stub")
+    parser.add_argument("--selenium-host", default="127.0.0.1")
+    parser.add_argument("--selenium-port", default="4444")
+    parser.add_argument("--render-workers", type=int, default=None)
+    parser.add_argument("--export-workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None, help="Directorio de trabajo, por defecto uno temporal")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=None, help="Resultados anteriores con los que comparar")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    report = {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+        "import_seconds": round(measure_import_time(), 4),
+        "runs": [],
+    }
+    print(f"Importar generar_infografias: {report['import_seconds']:.2f}s")
+
+    for size in sizes:
+        work_dir = os.path.join(args.work_dir, str(size)) if args.work_dir else tempfile.mkdtemp(prefix="benchmark_")
+        try:
+            run = run_benchmark(size, work_dir, args)
+        finally:
+            if not args.work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        report["runs"].append(run)
+        for result in run["results"]:
+            print(f"[{size} entidades] {result['stage']}: {result['seconds']:.2f}s, "
+                  f"{result['per_entity_ms']:.2f}ms por infografía, {result['per_second']:.1f} por segundo")
+
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, ensure_ascii=False, indent=1)
+    print(f"Resultados guardados en {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            regressions = compare_with_baseline(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Más lento que la referencia: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,56 +1,90 @@
-import base64
+import functools
 import json
+import logging
+import multiprocessing
 import os
 import sys
 import yaml
 import re
 import shutil
+import tempfile
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 
-import sass
 import jinja2
-import pngquant
 from jinja2 import TemplateNotFound, pass_context
 from markupsafe import Markup
 from pathvalidate import sanitize_filename
-from fuzzywuzzy import fuzz
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException
-from wakepy import keep
-from PIL import Image
-
-from .utils.translations import Translations
-from .utils.parser import Parser
+
+from .utils.entity_index import EntityIndex
+from .utils.files import atomic_write, get_tmp_path, remove_file
+from .utils.manifest import Manifest, hash_data, hash_file
+from .utils.backends import Rendition, SeleniumBackend, get_backend_class, get_selenium_urls
+from .utils.charts import pie_chart_svg
+from .utils.bundles import write_archive, write_pdf_bundle
+from .utils.metrics import metrics
 
 ROOT_DIR = os.path.dirname(__file__)
+# Hash of the SASS sources the CSS was compiled from, kept in static/css
+SASS_HASH_FILE = ".sass.sha256"
 
+@functools.lru_cache(maxsize=None)
 def get_custom_props():
+    # Read on first use instead of on import. The returned dict is shared, do not modify it
     config_file = os.path.join(ROOT_DIR, "config.yaml")
     with open(config_file, 'r', encoding='utf-8') as file:
         config = yaml.safe_load(file)
     return config
 
 
-custom_props = get_custom_props()
-export_percent = 0
-
-
-def compile_sass():
+def compile_sass(force=False):
+    # The CSS is only compiled again when the SASS sources change, the hash of the sources is kept with the CSS
     sass_dir = os.path.join(ROOT_DIR, "static/sass")
     css_dir = os.path.join(ROOT_DIR, "static/css")
+    hash_path = os.path.join(css_dir, SASS_HASH_FILE)
+
+    sources = sorted(file for file in os.listdir(sass_dir) if file.endswith(".scss"))
+    sources_hash = hash_data(*(f"{file}:{hash_file(os.path.join(sass_dir, file))}" for file in sources))
+    # Partials (_name.scss) are only included by other files, they have no CSS of their own
+    css_files = [os.path.join(css_dir, f"{os.path.splitext(file)[0]}.css") for file in sources if not file.startswith("_")]
+    if not force and all(os.path.isfile(css_file) for css_file in css_files):
+        try:
+            with open(hash_path, 'r', encoding='utf-8') as file:
+                if file.read().strip() == sources_hash:
+                    return False
+        except FileNotFoundError:
+            pass
+
+    import sass
 
     os.makedirs(css_dir, exist_ok=True)
+    # Compiled into a directory of its own and then moved into css_dir, other tasks can be reading the CSS or
+    # compiling it at the same time
+    compile_dir = tempfile.mkdtemp(prefix=".sass-", dir=css_dir)
+    try:
+        with metrics.stage("compile_sass"):
+            sass.compile(dirname=(sass_dir, compile_dir))
+        for css_file in css_files:
+            os.replace(os.path.join(compile_dir, os.path.basename(css_file)), css_file)
+    finally:
+        shutil.rmtree(compile_dir, ignore_errors=True)
+    # Written last, so an interrupted compilation is done again
+    with atomic_write(hash_path) as file:
+        file.write(sources_hash)
+    return True
 
-    for file in os.listdir(sass_dir):
-        if file.startswith("styles") and file.endswith(".scss"):
-            with open(os.path.join(sass_dir, file), 'r') as scss:
-                scss.read()
 
-    sass.compile(dirname=(sass_dir, css_dir))
+@functools.lru_cache(maxsize=None)
+def build_assets():
+    # CSS and translation files, built once per process before they are read instead of on import. The DAG builds
+    # them before the mapped tasks start, which then find them up to date
+    from .utils.translations import Translations
 
-compile_sass()
+    compile_sass()
+    Translations().generate_translations()
 
 
 def float_with_comma(value):
@@ -69,58 +103,279 @@ def is_float(value):
     except ValueError:
         return False
 
+# Compiled sub-templates of the subrender filter, keyed on their source. The same strings show up in many entities
+SUBRENDER_CACHE_SIZE = 4096
+subrender_plain_values = 0
+
+
+@functools.lru_cache(maxsize=SUBRENDER_CACHE_SIZE)
+def compile_fragment(environment, source):
+    return environment.from_string(source)
+
+
+def has_template_markup(value):
+    return "{" in value or "\r" in value or value.endswith("\n")
+
+
+def get_subrender_stats():
+    # Counters of this process, for profiling
+    cache_info = compile_fragment.cache_info()
+    return {"plain": subrender_plain_values, "hits": cache_info.hits, "misses": cache_info.misses,
+            "size": cache_info.currsize}
+
+
 @pass_context
 def subrender_filter(context, value):
-    _template = context.eval_ctx.environment.from_string(value)
-    result = _template.render(**context)
+    global subrender_plain_values
+    if isinstance(value, str) and not has_template_markup(value):
+        # Nothing to render, the result would be the same text
+        subrender_plain_values += 1
+        result = value
+    else:
+        _template = compile_fragment(context.eval_ctx.environment, value)
+        result = _template.render(**context)
     if context.eval_ctx.autoescape:
         result = Markup(result)
     return result
 
-def generar_infografias(output_path, mode, entities_data, entity_name=None, regenerate=False):
+@functools.lru_cache(maxsize=None)
+def get_template_env():
+    # Shared by every entity and language. Compiled templates are also kept on disk between runs
+    template_loader = jinja2.FileSystemLoader(searchpath=os.path.join(ROOT_DIR, "template"))
+    bytecode_cache = jinja2.FileSystemBytecodeCache(get_custom_props().get("JINJA_CACHE_DIR"))
+    template_env = jinja2.Environment(loader=template_loader, bytecode_cache=bytecode_cache, auto_reload=False)
+    template_env.filters['float'] = float_with_comma
+    template_env.filters['is_float'] = is_float
+    template_env.filters['subrender'] = subrender_filter
+    template_env.globals['pie_chart'] = pie_chart_svg
+    return template_env
+
+
+@functools.lru_cache(maxsize=None)
+def get_template(mode, lang):
+    template_env = get_template_env()
+    template_file = f"{mode}_{lang.upper()}.html"
+    try:
+        return template_env.get_template(template_file)
+    except TemplateNotFound:
+        return template_env.get_template(f"{mode}.html")
+
+
+@functools.lru_cache(maxsize=None)
+def get_static_files():
+    # (path relative to static, sha256) of every static file used by the infographics, hashed once per process.
+    # The SASS sources and the hidden files (the hash of the SASS sources) are not needed in the output
+    build_assets()
+    static_dir = os.path.join(ROOT_DIR, "static")
+    files = []
+    for root, dirs, filenames in os.walk(static_dir):
+        dirs[:] = sorted(directory for directory in dirs if directory != "sass" and not directory.startswith("."))
+        for filename in sorted(filenames):
+            if filename.startswith("."):
+                continue
+            file_path = os.path.join(root, filename)
+            files.append((os.path.relpath(file_path, static_dir), hash_file(file_path)))
+    return tuple(files)
+
+
+@functools.lru_cache(maxsize=None)
+def get_static_digest():
+    return hash_data("\n".join(f"{path}:{digest}" for path, digest in get_static_files()))
+
+
+# Settings of config.yaml that only change how a run is done, not its outputs. They are left out of the hash of the
+# inputs, changing them does not generate every infographic again
+RUN_SETTINGS = frozenset(["PARSE_CHUNK_SIZE", "RENDER_WORKERS", "SELENIUM_WORKERS", "IMAGE_WORKERS", "SELENIUM_RETRIES",
+                          "RENDER_TIMEOUT", "JINJA_CACHE_DIR", "METRICS_FILE", "BUNDLES"])
+
+
+def get_output_settings():
+    return {key: value for key, value in get_custom_props().items() if key not in RUN_SETTINGS}
+
+
+@functools.lru_cache(maxsize=None)
+def get_inputs_digest(mode, lang):
+    # Everything that ends up in an infographic apart from the entity data
+    template = get_template(mode, lang)
+    return hash_data(hash_file(template.filename), get_translations_from_lang(lang), get_output_settings(),
+                     get_static_digest())
+
+
+# Maximum number of infographics sent at once to a render process
+RENDER_CHUNK_SIZE = 50
+
+
+@dataclass
+class RenderTask:
+    index: int
+    entity: dict
+    lang: str
+    html_path: str
+    digest: str = None
+
+
+@metrics.timed("generar_infografias")
+def get_render_context():
+    # The render processes are not forked from the task: the SFTP, Selenium and upload threads can be holding
+    # locks (logging, SSL) that a forked child would inherit locked. forkserver forks them from a clean process
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+def generar_infografias(output_path, mode, entities_data, entity_name=None, regenerate=False, manifest=None, territories=None,
+                        workers=None, total_entities=None):
+    """
+    entities_data can be any iterable, like Parser.iter_infografias. The entities are rendered as they are read,
+    pass total_entities for the progress messages when it has no length.
+    """
     print("\n======== Generando ficheros HTML de las infografías =============")
+    custom_props = get_custom_props()
+    territories = territories or custom_props["TERRITORIOS"]
+    if workers is None:
+        workers = custom_props.get("RENDER_WORKERS") or 1
+    workers = int(workers)
     output_path = f"{output_path}/html"
     os.makedirs(output_path, exist_ok=True)
 
     if entity_name:
         entities_data = [entity for entity in entities_data if entity_name == entity["Nombre"]]
+    if entity_name or total_entities is None:
+        total_entities = len(entities_data)
 
-    total_entities = len(entities_data)
     print(f"Número de entidades: {total_entities}")
+    # Rendering is CPU bound, with several workers the tasks are sent in chunks to a pool of processes. Each
+    # process keeps its own template environment and translations
+    chunk_size = max(1, min(RENDER_CHUNK_SIZE, -(-total_entities // (workers * 4))))
+    render_chunks = iter_chunks(get_render_tasks(output_path, mode, entities_data, regenerate, manifest, territories,
+                                                 total_entities), chunk_size)
+    worker_times = []
+    render_count = 0
+    start = time.perf_counter()
+    if workers == 1:
+        for chunk in render_chunks:
+            worker_times.append(render_infografias(mode, chunk, total_entities))
+            update_manifest(manifest, chunk)
+            render_count += len(chunk)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_render_context()) as executor:
+            # Only a few chunks wait for a process, so the entities still to be read are not kept in memory
+            pending = {}
+            for chunk in render_chunks:
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    render_count += collect_render_results(done, pending, worker_times, manifest)
+                pending[executor.submit(render_infografias, mode, chunk, total_entities)] = chunk
+            render_count += collect_render_results(list(pending), pending, worker_times, manifest)
+    elapsed = time.perf_counter() - start
+
+    if render_count:
+        print_render_times(worker_times, render_count, workers, elapsed)
+
+
+def get_render_tasks(output_path, mode, entities_data, regenerate, manifest, territories, total_entities):
+    custom_props = get_custom_props()
     for index, entity in enumerate(entities_data):
-        if not custom_props["TERRITORIOS"] or entity['Codigo Territorio'].upper() in custom_props["TERRITORIOS"]:
-            print(f"[{index+1}/{total_entities}] Generando infografia para la entidad {entity['Nombre']}...")
+        if not territories or entity['Codigo Territorio'].upper() in territories:
             filename = sanitize_filename(entity["NIF"])
             langs = entity['Idioma'].split(';')
             for lang in langs:
                 if not custom_props["IDIOMAS"] or lang.upper() in custom_props["IDIOMAS"]:
-                    translations = get_translations_from_lang(lang)
                     html_root = f"{output_path}/{entity['Codigo Territorio'].upper()}/{lang.upper()}"
                     os.makedirs(html_root, exist_ok=True)
                     html_path = f"{html_root}/{filename}.html"
-                    if regenerate or not os.path.isfile(html_path):
-                        template_loader = jinja2.FileSystemLoader(searchpath=os.path.join(ROOT_DIR, "template"))
-                        template_env = jinja2.Environment(loader=template_loader)
-                        template_env.filters['float'] = float_with_comma
-                        template_env.filters['is_float'] = is_float
-                        template_env.filters['subrender'] = subrender_filter
-                        template_file = f"{mode}_{lang.upper()}.html"
-                        try:
-                            template = template_env.get_template(template_file)
-                        except TemplateNotFound:
-                            template = template_env.get_template(f"{mode}.html")
-
-                        output_text = template.render(**{**entity, **translations, **custom_props})
-
-                        html_file = open(html_path, 'w', encoding="utf-8")
-                        html_file.write(output_text)
-                        html_file.close()
-                        print(f"[{index+1}/{total_entities}] Infografía para la entidad [{entity['Nombre']}] generada.")
+                    if manifest is None:
+                        digest = None
+                        up_to_date = os.path.isfile(html_path)
+                    else:
+                        digest = hash_data(entity, get_inputs_digest(mode, lang))
+                        up_to_date = manifest.is_current(html_path, digest)
+
+                    if regenerate or not up_to_date:
+                        yield RenderTask(index, entity, lang, html_path, digest)
                     else:
+                        metrics.count("html_up_to_date")
                         print(f"[{index + 1}/{total_entities}] Infografía para la entidad [{entity['Nombre']}] ya existe.")
 
 
+def iter_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def collect_render_results(futures, pending, worker_times, manifest):
+    # The manifest is updated as soon as every chunk is rendered, returns the number of infographics rendered
+    render_count = 0
+    for future in futures:
+        chunk = pending.pop(future)
+        worker_times.append(future.result())
+        update_manifest(manifest, chunk)
+        render_count += len(chunk)
+    return render_count
+
+
+def update_manifest(manifest, render_tasks):
+    if manifest is not None:
+        for task in render_tasks:
+            manifest.update(task.html_path, task.digest)
+
+
+def render_infografias(mode, render_tasks, total_entities):
+    # Returns the process that rendered the infographics, how many, the wall and CPU time it took, the subrender
+    # cache counters and the time of every infographic
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    stats_start = get_subrender_stats()
+    render_times = []
+    for task in render_tasks:
+        task_start = time.perf_counter()
+        template = get_template(mode, task.lang)
+        output_text = template.render(**{**task.entity, **get_lang_context(task.lang)})
+
+        with open(task.html_path, 'w', encoding="utf-8") as html_file:
+            html_file.write(output_text)
+        render_times.append(time.perf_counter() - task_start)
+        print(f"[{task.index + 1}/{total_entities}] Infografía para la entidad [{task.entity['Nombre']}] generada.",
+              flush=True)
+    subrender_stats = {key: value - stats_start[key] for key, value in get_subrender_stats().items() if key != "size"}
+    return (os.getpid(), len(render_tasks), time.perf_counter() - start, time.process_time() - cpu_start, subrender_stats,
+            render_times)
+
+
+def print_render_times(worker_times, total_tasks, workers, elapsed):
+    times_by_worker = {}
+    subrender_stats = {"plain": 0, "hits": 0, "misses": 0}
+    for pid, count, worker_elapsed, worker_cpu, worker_subrender_stats, render_times in worker_times:
+        for key, value in worker_subrender_stats.items():
+            subrender_stats[key] += value
+            metrics.count(f"subrender_{key}", value)
+        for render_time in render_times:
+            metrics.add_time("render_html", render_time)
+        metrics.count("html_rendered", count)
+        worker_count, worker_total, worker_cpu_total = times_by_worker.get(pid, (0, 0, 0))
+        times_by_worker[pid] = (worker_count + count, worker_total + worker_elapsed, worker_cpu_total + worker_cpu)
+
+    for pid, (count, worker_elapsed, worker_cpu) in sorted(times_by_worker.items()):
+        print(f"Proceso {pid}: {count} infografías renderizadas en {worker_elapsed:.2f}s ({worker_cpu:.2f}s de CPU)")
+    # CPU time of all the processes over the wall time: the cores busy rendering on average. It is not a speedup,
+    # compare the infographics per second with a run with RENDER_WORKERS: 1 (or the benchmark) for that
+    cpu_time = sum(worker_cpu for _, _, worker_cpu in times_by_worker.values())
+    print(f"{total_tasks} infografías renderizadas en {elapsed:.2f}s con {workers} procesos "
+          f"({total_tasks / elapsed if elapsed else 0:.1f} por segundo, "
+          f"{cpu_time / elapsed if elapsed else 0:.2f} núcleos de CPU ocupados de media)")
+    print(f"Filtro subrender: {subrender_stats['plain']} valores sin plantilla, {subrender_stats['hits']} aciertos y "
+          f"{subrender_stats['misses']} fallos de la caché de plantillas compiladas")
+
+
+@functools.lru_cache(maxsize=None)
 def get_translations_from_lang(lang):
+    # Loaded once per language and process. The returned dict is shared, do not modify it
+    build_assets()
     translations = {}
     translations_dir = os.path.join(ROOT_DIR, "translations")
 
@@ -130,137 +385,376 @@ def get_translations_from_lang(lang):
     except FileNotFoundError:
         pass
 
+    # Translations with template markup are compiled once, before any entity is rendered
+    for value in translations.values():
+        if isinstance(value, str) and ("{{" in value or "{%" in value):
+            compile_fragment(get_template_env(), value)
+
     return translations
 
+
+@functools.lru_cache(maxsize=None)
+def get_lang_context(lang):
+    # Part of the template context shared by every entity in the same language
+    custom_props = get_custom_props()
+    static_charts = get_backend_class(custom_props.get("EXPORT_BACKEND")).static_charts
+    return {**get_translations_from_lang(lang), **custom_props, "STATIC_CHARTS": static_charts}
+
+
+@metrics.timed("copy_static_files")
 def copy_static_files(output_path):
+    # Only the files that are not already in the output with the same size and modification time are copied. They
+    # are only needed to export the infographics, they are not in the manifest: the DAG uploads them once per run
     static_dir = "static"
     source = os.path.join(ROOT_DIR, static_dir)
     dest = os.path.join(output_path, "html", static_dir)
-    shutil.copytree(source, dest, dirs_exist_ok=True)
+    for path, _ in get_static_files():
+        source_file = os.path.join(source, path)
+        dest_file = os.path.join(dest, path)
+        if is_same_file(source_file, dest_file):
+            metrics.count("static_files_skipped")
+            continue
+        link_or_copy(source_file, dest_file)
+        metrics.count("static_files_copied")
 
-def exportar_infografias(output_path, nif, regenerate, selenium_host, selenium_port):
-    global export_percent
-    print("\n\n======== Exportando infografías =============")
 
-    options = webdriver.ChromeOptions()
-    options.add_argument('--hide-scrollbars')
-    options.add_argument('--window-size=2480,3508')
-    options.add_experimental_option('excludeSwitches', ['enable-logging'])
-    options.add_argument('--log-level=3')
+def is_same_file(source_file, dest_file):
+    try:
+        dest_stat = os.stat(dest_file)
+    except FileNotFoundError:
+        return False
+    source_stat = os.stat(source_file)
+    return source_stat.st_size == dest_stat.st_size and source_stat.st_mtime_ns == dest_stat.st_mtime_ns
 
-    with webdriver.Remote(f"http://{selenium_host}:{selenium_port}/wd/hub", options=options) as driver:
-        html_path = os.path.join(ROOT_DIR, output_path, "html")
-        total_tasks = get_file_count(html_path)
-        territories_dirs = [file for file in os.listdir(html_path) if file != "static"]
-        for territory in territories_dirs:
-            if not custom_props["TERRITORIOS"] or territory.upper() in custom_props["TERRITORIOS"]:
-                lang_dirs = os.listdir(f"{html_path}/{territory}")
-                for lang in lang_dirs:
-                    if not custom_props["IDIOMAS"] or lang.upper() in custom_props["IDIOMAS"]:
+
+def link_or_copy(source_file, dest_file):
+    # A hard link writes no data. The file is copied when the output is on another file system. It is linked under
+    # a temporary name that then replaces dest_file, other tasks can be copying the same files to the same output
+    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+    tmp_file = get_tmp_path(dest_file)
+    try:
+        try:
+            os.link(source_file, tmp_file)
+        except OSError:
+            shutil.copy2(source_file, tmp_file)
+        os.replace(tmp_file, dest_file)
+    finally:
+        # os.replace leaves tmp_file when both are links to the same file
+        remove_file(tmp_file)
+
+
+@dataclass
+class ExportTask:
+    territory: str
+    lang: str
+    filename: str
+    digest: str = None
+
+
+class ExportProgress:
+    # Thread-safe export counter shared by all the selenium workers
+    def __init__(self, total_tasks):
+        self.total_tasks = total_tasks
+        self.done = 0
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def advance(self):
+        with self._lock:
+            self.done += 1
+            return self.percent()
+
+    def fail(self, task):
+        with self._lock:
+            self.failed.append(task)
+
+    def percent(self):
+        if not self.total_tasks:
+            return 100
+        return 100 * self.done / self.total_tasks
+
+
+def get_export_tasks(output_path, html_path, nif, regenerate=False, manifest=None, territories=None, renditions=(),
+                     filenames=None):
+    # filenames limits the tasks to the infographics of one data file, the HTML of every data file is in the same
+    # directories
+    custom_props = get_custom_props()
+    territories = territories or custom_props["TERRITORIOS"]
+    tasks = []
+    territories_dirs = [file for file in os.listdir(html_path) if file != "static"]
+    for territory in territories_dirs:
+        if not territories or territory.upper() in territories:
+            lang_dirs = os.listdir(f"{html_path}/{territory}")
+            for lang in lang_dirs:
+                if not custom_props["IDIOMAS"] or lang.upper() in custom_props["IDIOMAS"]:
+                    if nif:
+                        # Only the HTML of that entity, without listing the whole directory
+                        filename = f"{sanitize_filename(nif)}.html"
+                        files_list = [filename] if os.path.isfile(f"{html_path}/{territory}/{lang}/{filename}") else []
+                    else:
                         files_list = os.listdir(f"{html_path}/{territory}/{lang}")
+                        if filenames is not None:
+                            files_list = [file for file in files_list if os.path.splitext(file)[0] in filenames]
 
-                        if nif:
-                            files_list = [filename for filename in files_list if nif == filename.split(".")[0]]
+                    for filename in files_list:
+                        task = ExportTask(territory, lang, filename.split('.')[0])
+                        if manifest is not None:
+                            # PNG, PDF and renditions are up to date when they were generated from the current HTML
+                            task.digest = manifest.get(f"{html_path}/{territory}/{lang}/{filename}")
+                            if not regenerate and all(manifest.is_current(output, task.digest)
+                                                      for output in get_output_paths(output_path, task, renditions)):
+                                continue
+                        tasks.append(task)
+    return tasks
 
-                        for filename in files_list:
-                            filename = filename.split('.')[0]
-                            input_file = f"{html_path}/{territory}/{lang}/{filename}.html"
-                            print(f"Input file: file://{input_file}")
-                            driver.delete_all_cookies()
-                            # driver.execute_cdp_cmd('Storage.clearDataForOrigin', {
-                            #     "origin": '*',
-                            #     "storageTypes": 'all',
-                            # })
 
-                            try:
-                                driver.get(f"file://{input_file}")
-                                WebDriverWait(driver, 3).until(EC.presence_of_element_located((By.CLASS_NAME, "highcharts-container")))
-                            except TimeoutException:
-                                print("Timout waiting for highchart to load.")
-                            export_percent += 100 / total_tasks
-                            html2img(driver, filename, extension="png", output_path=f"{output_path}/png/{territory}/{lang}", regenerate=regenerate)
-                            img2pdf(filename, input_path=f"{output_path}/png/{territory}/{lang}", output_path=f"{output_path}/pdf/{territory}/{lang}")
-                            # html2img(driver, filename, extension="jpg", output_path=f"infografias/jpg/{territory}/{lang}", regenerate=regenerate)
-                            # html2pdf(driver, filename, output_path=f"infografias/pdf/{territory}/{lang}", regenerate=regenerate)
+def get_png_path(output_path, task):
+    return f"{output_path}/png/{task.territory}/{task.lang}/{task.filename}.png"
 
 
-def get_file_count(path):
-    file_list = []
+def get_pdf_path(output_path, task):
+    return f"{output_path}/pdf/{task.territory}/{task.lang}/{task.filename}.pdf"
 
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if file.split(".")[-1] == "html":
-                file_path = os.path.join(root, file)
-                file_list.append(file_path)
 
-    return len(file_list)
+def get_rendition_path(output_path, task, rendition):
+    return f"{output_path}/{rendition.name}/{task.territory}/{task.lang}/{task.filename}.{rendition.format}"
 
 
-def html2pdf(driver, filename, output_path="infografias/pdf", regenerate=False):
-    global export_percent
+def get_output_paths(output_path, task, renditions=()):
+    return [get_png_path(output_path, task), get_pdf_path(output_path, task)] + \
+        [get_rendition_path(output_path, task, rendition) for rendition in renditions]
 
-    os.makedirs(output_path, exist_ok=True)
-    pdf_path = f"{output_path}/{filename.split('.')[0]}.pdf"
-
-    if regenerate or not os.path.isfile(pdf_path):
-        print(f"[{round(export_percent)}%] Exportando infografía {filename.split('.')[0]} en formato PDF.")
-        params = {
-            "paperWidth": 8.268,
-            "paperHeight": 11.693,
-            "marginTop": 0,
-            "marginLeft": 0,
-            "marginBottom": 0,
-            "marginRight": 0,
-            "pageRanges": "1",
-            "printBackground": True
-        }
-        pdf = driver.execute_cdp_cmd('Page.printToPDF', params)
-        decoded = base64.b64decode(pdf["data"])
-        with open(pdf_path, 'wb') as output_file:
-            output_file.write(decoded)
-
-        print(f"[{round(export_percent)}%] Infografía exportada a PDF [{pdf_path}]")
-    else:
-        print(f"[{round(export_percent)}%] Infografía [{pdf_path}] ya existe")
 
+def get_renditions():
+    renditions = []
+    for rendition in get_custom_props().get("RENDITIONS") or []:
+        image_format = str(rendition.get("format") or "png").lower()
+        name = rendition.get("name") or f"{image_format}_{rendition['width']}"
+        renditions.append(Rendition(name, int(rendition["width"]), image_format))
+    return renditions
 
-def html2img(driver, filename, extension, output_path="infografias/png", regenerate=False):
-    global export_percent
 
-    os.makedirs(output_path, exist_ok=True)
-    img_path = f"{output_path}/{filename}.{extension}"
+def exportar_infografia(backend, session, task, output_path, html_path, regenerate, percent, manifest=None, on_exported=None):
+    # Returns a Future when the backend is still writing the files in the background
+    input_file = f"{html_path}/{task.territory}/{task.lang}/{task.filename}.html"
+    print(f"Input file: file://{input_file}")
 
-    if regenerate or not os.path.isfile(img_path):
-        print(f"[{round(export_percent)}%] Exportando infografia en formato {extension.upper()} [{img_path}]...")
-        driver.set_window_size(width=2480, height=3700)
-        driver.save_screenshot(filename=img_path)
-        try:
-            pngquant.config(custom_props["PNGQUANT_PATH"], min_quality=85, max_quality=85)
-            pngquant.quant_image(img_path)
-        except KeyError as e:
-            print(e)
-            print("No es posible optimizar la imagen")
-            print("- Añade la ubicación de pngquant en el archivo config.yaml usando la propiedad PNGQUANT_PATH.")
-            print("Puedes descargarlo en https://pngquant.org/")
-        print(f"[{round(export_percent)}%] Infografía exportada a {extension.upper()} [{img_path}]")
-    else:
-        print(f"[{round(export_percent)}%] Infografía [{img_path}] ya existe")
+    outputs = get_output_paths(output_path, task, backend.renditions)
 
+    def on_done():
+        metrics.count("exported")
+        if manifest is not None:
+            for output in outputs:
+                manifest.update(output, task.digest)
+        if on_exported is not None:
+            # The HTML is not needed anymore once its PNG, PDF and renditions exist
+            on_exported([output for output in [input_file] + outputs if os.path.isfile(output)])
 
-def img2pdf(filename, input_path, output_path, regenerate=False):
-    os.makedirs(output_path, exist_ok=True)
-    input_path = input_path + f"/{filename}.png"
-    output_path = output_path + f"/{filename}.pdf"
-    if regenerate or not os.path.isfile(output_path):
-        print(f"[{round(export_percent)}%] Exportando infografia en formato PDF [{output_path}]...")
-        image = Image.open(input_path).convert("RGB")
-        image.save(output_path, optimize=True, quality=65)
-        print(f"[{round(export_percent)}%] Infografía exportada a PDF [{output_path}]")
-    else:
-        print(f"[{round(export_percent)}%] Infografía [{output_path}] ya existe")
+    rendition_paths = [(rendition, get_rendition_path(output_path, task, rendition)) for rendition in backend.renditions]
+    return backend.export(session, input_file, task.filename, png_dir=f"{output_path}/png/{task.territory}/{task.lang}",
+                          pdf_dir=f"{output_path}/pdf/{task.territory}/{task.lang}", regenerate=regenerate, percent=percent,
+                          on_done=on_done, rendition_paths=rendition_paths)
+
+
+def export_worker(worker_id, backend, tasks, progress, output_path, html_path, regenerate, max_retries, manifest=None,
+                  on_exported=None):
+    session = None
+    opened = False
+    pending = []
+    try:
+        while True:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                break
+
+            attempt = 0
+            while True:
+                try:
+                    if not opened:
+                        session = backend.open(worker_id)
+                        opened = True
+                    future = exportar_infografia(backend, session, task, output_path, html_path, regenerate,
+                                                 progress.percent(), manifest, on_exported)
+                    if future is not None:
+                        pending.append((task, future))
+                    break
+                except backend.recoverable_errors as e:
+                    attempt += 1
+                    metrics.count("export_retries")
+                    print(f"[worker {worker_id}] Error exportando [{task.territory}/{task.lang}/{task.filename}] "
+                          f"(intento {attempt}/{max_retries + 1}): {e}")
+                    # Drop the session, it is recreated on the next attempt
+                    if opened:
+                        backend.close(session)
+                    session = None
+                    opened = False
+                    if attempt > max_retries:
+                        metrics.count("export_failures")
+                        progress.fail(task)
+                        break
+            progress.advance()
+    finally:
+        if opened:
+            backend.close(session)
+
+    # Files still being written by the backend
+    for task, future in pending:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"[worker {worker_id}] Error guardando [{task.territory}/{task.lang}/{task.filename}]: {e}")
+            metrics.count("export_failures")
+            progress.fail(task)
+
+
+def get_export_backend(selenium_host, selenium_port):
+    custom_props = get_custom_props()
+    backend_class = get_backend_class(custom_props.get("EXPORT_BACKEND"))
+    if backend_class is SeleniumBackend:
+        return SeleniumBackend(get_selenium_urls(selenium_host, selenium_port), custom_props.get("PNGQUANT_PATH"),
+                               render_timeout=custom_props.get("RENDER_TIMEOUT") or 10,
+                               image_workers=custom_props.get("IMAGE_WORKERS"), renditions=get_renditions(),
+                               crop_selector=custom_props.get("CROP_SELECTOR"))
+    return backend_class(custom_props.get("PNGQUANT_PATH"), renditions=get_renditions())
+
+
+@metrics.timed("exportar_infografias")
+def exportar_infografias(output_path, nif, regenerate, selenium_host, selenium_port, workers=None, max_retries=None, manifest=None,
+                         backend=None, on_exported=None, territories=None, filenames=None):
+    print("\n\n======== Exportando infografías =============")
+    custom_props = get_custom_props()
+
+    if workers is None:
+        workers = custom_props.get("SELENIUM_WORKERS") or 1
+    if max_retries is None:
+        max_retries = custom_props.get("SELENIUM_RETRIES") or 0
+    workers = int(workers)
+    max_retries = int(max_retries)
+
+    if backend is None:
+        backend = get_export_backend(selenium_host, selenium_port)
+
+    html_path = os.path.join(ROOT_DIR, output_path, "html")
+    export_tasks = get_export_tasks(output_path, html_path, nif, regenerate, manifest, territories, backend.renditions,
+                                    filenames)
+    if manifest is not None:
+        # Outdated outputs are filtered out already, the remaining ones have to be replaced
+        regenerate = True
+    progress = ExportProgress(len(export_tasks))
+
+    tasks = queue.Queue()
+    for task in export_tasks:
+        tasks.put(task)
+    workers = max(1, min(workers, len(export_tasks)))
+    print(f"Exportando {len(export_tasks)} infografías con {workers} sesiones de {backend.name}")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(export_worker, worker_id, backend, tasks, progress, output_path, html_path,
+                                   regenerate, max_retries, manifest, on_exported)
+                   for worker_id in range(workers)]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            backend.shutdown()
+
+    summary = backend.summary()
+    if summary:
+        print(summary)
+
+    if progress.failed:
+        failed_files = ", ".join(f"{task.territory}/{task.lang}/{task.filename}" for task in progress.failed)
+        raise RuntimeError(f"No se han podido exportar {len(progress.failed)} infografías: {failed_files}")
+
+
+BUNDLE_FORMATS = ("pdf", "zip", "tar")
+
+
+def get_bundle_formats():
+    bundles = get_custom_props().get("BUNDLES") or []
+    if isinstance(bundles, str):
+        bundles = bundles.split(",")
+    bundles = [str(bundle).strip().lower() for bundle in bundles if str(bundle).strip()]
+    for bundle in bundles:
+        if bundle not in BUNDLE_FORMATS:
+            raise ValueError(f"Formato de paquete desconocido: {bundle}. Disponibles: {', '.join(BUNDLE_FORMATS)}")
+    return bundles
+
+
+def get_bundle_path(output_path, mode, territory, lang, bundle_format):
+    return f"{output_path}/bundles/{mode}_{territory}_{lang}.{bundle_format}"
+
+
+@metrics.timed("empaquetar_infografias")
+def empaquetar_infografias(output_path, mode, bundle_formats, filenames=None, territories=None, manifest=None, regenerate=False,
+                           on_exported=None):
+    # One multi-page PDF and/or archive per territory and language, built from the exported files on disk.
+    # filenames limits them to the infographics of one data file, as all of them are exported to the same directories
+    print("\n\n======== Empaquetando infografías =============")
+    custom_props = get_custom_props()
+    territories = territories or custom_props["TERRITORIOS"]
+    png_root = f"{output_path}/png"
+    if not os.path.isdir(png_root):
+        return
+    os.makedirs(f"{output_path}/bundles", exist_ok=True)
+    output_dirs = ["png", "pdf"] + [rendition.name for rendition in get_renditions()]
+
+    for territory in sorted(os.listdir(png_root)):
+        if territories and territory.upper() not in territories:
+            continue
+        for lang in sorted(os.listdir(f"{png_root}/{territory}")):
+            if custom_props["IDIOMAS"] and lang.upper() not in custom_props["IDIOMAS"]:
+                continue
+            png_paths = [f"{png_root}/{territory}/{lang}/{filename}"
+                         for filename in sorted(os.listdir(f"{png_root}/{territory}/{lang}"))
+                         if filename.endswith(".png") and (filenames is None or filename[:-4] in filenames)]
+            if not png_paths:
+                continue
+            members = []
+            for output_dir in output_dirs:
+                member_dir = f"{output_path}/{output_dir}/{territory}/{lang}"
+                if os.path.isdir(member_dir):
+                    members += [(f"{member_dir}/{filename}", f"{output_dir}/{filename}")
+                                for filename in sorted(os.listdir(member_dir))
+                                if filenames is None or os.path.splitext(filename)[0] in filenames]
+
+            if manifest is None:
+                digest = None
+                newest_member = max((os.path.getmtime(path) for path, _ in members), default=0)
+            else:
+                digest = hash_data("\n".join(f"{name}:{manifest.get(path)}" for path, name in members))
+
+            bundle_paths = []
+            for bundle_format in bundle_formats:
+                bundle_path = get_bundle_path(output_path, mode, territory, lang, bundle_format)
+                if manifest is None:
+                    up_to_date = os.path.isfile(bundle_path) and os.path.getmtime(bundle_path) >= newest_member
+                else:
+                    up_to_date = manifest.is_current(bundle_path, digest)
+                if not regenerate and up_to_date:
+                    print(f"Paquete [{bundle_path}] ya existe")
+                    continue
+
+                print(f"Empaquetando {len(png_paths)} infografías en [{bundle_path}]...")
+                with metrics.stage(f"bundle_{bundle_format}"):
+                    if bundle_format == "pdf":
+                        write_pdf_bundle(png_paths, bundle_path)
+                    else:
+                        write_archive(members, bundle_path, bundle_format)
+                metrics.count("bundle_bytes", os.path.getsize(bundle_path))
+                if manifest is not None:
+                    manifest.update(bundle_path, digest)
+                bundle_paths.append(bundle_path)
+                print(f"Paquete [{bundle_path}] generado")
+
+            if on_exported is not None and bundle_paths:
+                on_exported(bundle_paths)
 
 
 def get_driver():
+    from selenium import webdriver
+
     options = webdriver.ChromeOptions()
     options.add_argument("-headless")
     options.add_argument('--hide-scrollbars')
@@ -272,20 +766,21 @@ def get_driver():
     return driver
 
 
-def find_best_match(input_text, string_list):
-    string_scores = {string: fuzz.token_sort_ratio(input_text, string) for string in string_list}
-    string_scores = sorted(string_scores.items(), key=lambda item: item[1], reverse=True)
-    top_matches = string_scores[:3]  # Get best three matches
+def find_best_match(input_text, entity_index):
+    # Returns the EntityInfo of the entity in entity_index whose name is the most similar to input_text
+    top_matches = entity_index.search(input_text, limit=3)  # Get best three matches
+    if not top_matches:
+        print(f"No hay ninguna entidad parecida a [{input_text}]")
+        exit(-1)
     top_score = top_matches[0][1]
     if top_score >= 95:
         return top_matches[0][0]
     else:
-        print(f"1. {top_matches[0][0]}")
-        print(f"2. {top_matches[1][0]}")
-        print(f"3. {top_matches[2][0]}")
+        for number, (entity, _) in enumerate(top_matches, 1):
+            print(f"{number}. {entity.name}")
         user_input = input("Selecciona una entidad escribiendo el número de su izquierda: ")
 
-        if user_input in ["1", "2", "3"]:
+        if user_input in [str(number) for number in range(1, len(top_matches) + 1)]:
             return top_matches[int(user_input)-1][0]
         else:
             exit(-1)
@@ -304,25 +799,111 @@ def get_args():
     return entity_name, regenerate
 
 
-Translations().generate_translations()
+def get_mode(data_file):
+    # "datos entidades.csv" -> "entidades"
+    return re.search(r".* (.*).csv", data_file).group(1)
+
+
+def get_manifest_name(mode, territories=None):
+    # The runs of every data file and territory can write to the same output path at the same time, each of them
+    # keeps its own manifest
+    if not territories:
+        return Manifest.filename
+    return f"manifest_{mode}_{'_'.join(sorted(territory.upper() for territory in territories))}.json"
+
+
+def get_manifest(output_path, data_file, territories=None):
+    return Manifest(output_path, get_manifest_name(get_mode(data_file), territories))
+
+
+def get_metrics_path(output_path, mode, territories=None):
+    metrics_file = get_custom_props()["METRICS_FILE"]
+    if territories:
+        name, extension = os.path.splitext(metrics_file)
+        metrics_file = f"{name}_{mode}_{'_'.join(sorted(territory.upper() for territory in territories))}{extension}"
+    return os.path.join(output_path, metrics_file)
+
+
+def collect_filenames(entities_data, filenames):
+    # Adds the filename of every entity to filenames as the entities go through
+    for entity in entities_data:
+        filenames.add(sanitize_filename(entity["NIF"]))
+        yield entity
+
 
 # Asumes a selenium service running in localhost at port 4444. This is required for exporting the PNGs
-def run(data_file, output_path="infografias", entity_name=None, regenerate=False, selenium_host="127.0.0.1", selenium_port="4444"):
-    entities_data = Parser().parse_infografias(data_file)
+def run(data_file, output_path="infografias", entity_name=None, regenerate=False, selenium_host="127.0.0.1", selenium_port="4444",
+        selenium_workers=None, incremental=False, on_exported=None, territories=None):
+    """
+    With incremental=True a manifest with the hash of the inputs of every output is kept in output_path, and only
+    the outputs whose inputs changed are generated again. Returns the outputs to upload in that case: the ones
+    generated in this run and the ones of previous runs that are still pending. Call Manifest.remove_pending
+    (get_manifest) once they are uploaded.
+
+    on_exported is called from the export workers with the HTML, PNG and PDF files of every infographic as soon as
+    they are exported, so they can be uploaded while the rest are still being exported. It can not be used with
+    BUNDLES, the bundles are built from the exported files once all of them are on disk.
+
+    territories limits the run to those territory codes instead of the TERRITORIOS of config.yaml, so several runs
+    of the same data file can be split by territory. Each data file and territory keeps its own manifest, and only
+    exports the infographics of its own entities.
+
+    The time of every stage and the counters of the run are collected in utils.metrics.metrics, and saved to
+    METRICS_FILE in output_path when it is set, named after the mode and territories like the manifest.
+    """
+    from wakepy import keep
+    from .utils.parser import Parser
+
+    build_assets()
+    custom_props = get_custom_props()
+    mode = get_mode(data_file)
+    if territories:
+        territories = [territory.upper() for territory in territories]
+    manifest = get_manifest(output_path, data_file, territories) if incremental else None
+    parser = Parser()
     nif_to_export = None
     if entity_name is not None:
-        entity_name = find_best_match(entity_name, [entity["Nombre"] for entity in entities_data])
-        nif_to_export = next((entity["NIF"] for entity in entities_data if entity["Nombre"] == entity_name))
+        # Only the names and NIFs are read to find the entity, and then only its column is parsed
+        entity_index = EntityIndex(parser.parse_entity_info(data_file, territories))
+        entity_info = find_best_match(entity_name, entity_index)
+        entities_data = list(parser.iter_infografias(data_file, territories, columns=[entity_info.column]))
+        nif_to_export = entities_data[0]["NIF"]
+        total_entities = len(entities_data)
+    else:
+        # The entities are rendered as they are parsed, they are never all in memory at once
+        total_entities = len(parser.get_entity_columns(data_file, territories))
+        entities_data = parser.iter_infografias(data_file, territories, custom_props.get("PARSE_CHUNK_SIZE"))
+
+    bundle_formats = get_bundle_formats() if nif_to_export is None else []
+    if bundle_formats and on_exported is not None:
+        raise ValueError("No se pueden generar paquetes (BUNDLES) subiendo las infografías a medida que se exportan")
+    filenames = set()
+    try:
+        generar_infografias(output_path, mode, collect_filenames(entities_data, filenames), regenerate=regenerate,
+                            manifest=manifest, territories=territories, total_entities=total_entities)
+        copy_static_files(output_path)
+
+        with keep.presenting() as k:
+            exportar_infografias(output_path, nif_to_export, regenerate, selenium_host, selenium_port,
+                                 workers=selenium_workers, manifest=manifest, on_exported=on_exported,
+                                 territories=territories, filenames=filenames)
 
-    mode = re.search(r".* (.*).csv", data_file).group(1)
-    generar_infografias(output_path, mode, entities_data, entity_name, regenerate)
-    copy_static_files(output_path)
+        if bundle_formats:
+            empaquetar_infografias(output_path, mode, bundle_formats, filenames, territories, manifest, regenerate)
+    finally:
+        if manifest is not None:
+            manifest.save()
+        if custom_props.get("METRICS_FILE"):
+            metrics.save(get_metrics_path(output_path, mode, territories))
 
-    with keep.presenting() as k:
-        exportar_infografias(output_path, nif_to_export, regenerate, selenium_host, selenium_port)
+    if manifest is not None:
+        return manifest.get_pending()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     entity_name, regenerate = get_args()
+    custom_props = get_custom_props()
     for datos_infografias in custom_props["ARCHIVOS_INFOGRAFIAS"].split(', '):
         run(f'{custom_props["DIRECTORIO_INFOGRAFIAS"]}/{datos_infografias}', entity_name=entity_name, regenerate=regenerate)
+    metrics.log_summary()
@@ -0,0 +1,58 @@
+import tarfile
+import zipfile
+
+import pytest
+from PIL import Image
+
+from geninfografia.utils.bundles import write_archive, write_pdf_bundle
+
+# Different sizes, every page has to keep the size of its own image
+IMAGE_SIZES = [(120, 80), (60, 200), (33, 33)]
+
+
+@pytest.fixture
+def png_paths(tmp_path):
+    paths = []
+    for index, size in enumerate(IMAGE_SIZES):
+        path = tmp_path / f"infografia_{index}.png"
+        Image.new("RGBA", size, (200, 40 * index, 60, 255)).save(path)
+        paths.append(str(path))
+    return paths
+
+
+def test_pdf_bundle_has_one_page_per_image(tmp_path, png_paths):
+    pdfium = pytest.importorskip("pypdfium2")
+    pdf_path = tmp_path / "infografias.pdf"
+    write_pdf_bundle(png_paths, str(pdf_path))
+
+    assert not (tmp_path / "infografias.pdf.tmp").exists()
+    pdf = pdfium.PdfDocument(str(pdf_path))
+    try:
+        assert len(pdf) == len(IMAGE_SIZES)
+        assert [tuple(round(side) for side in pdf[index].get_size()) for index in range(len(pdf))] == IMAGE_SIZES
+    finally:
+        pdf.close()
+
+
+@pytest.mark.parametrize("archive_format", ["zip", "tar"])
+def test_archive_round_trip(tmp_path, png_paths, archive_format):
+    archive_path = tmp_path / f"infografias.{archive_format}"
+    files = [(path, f"png/{index}.png") for index, path in enumerate(png_paths)]
+    write_archive(files, str(archive_path), archive_format)
+
+    if archive_format == "zip":
+        with zipfile.ZipFile(archive_path) as archive:
+            contents = {name: archive.read(name) for name in archive.namelist()}
+    else:
+        with tarfile.open(archive_path) as archive:
+            contents = {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+    expected = {}
+    for path, name in files:
+        with open(path, "rb") as file:
+            expected[name] = file.read()
+    assert contents == expected
+
+
+def test_archive_unknown_format(tmp_path, png_paths):
+    with pytest.raises(ValueError):
+        write_archive([(png_paths[0], "0.png")], str(tmp_path / "infografias.rar"), "rar")
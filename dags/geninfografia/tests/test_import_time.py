@@ -0,0 +1,28 @@
+import json
+import os
+import subprocess
+import sys
+
+from geninfografia.benchmark import measure_import_time
+
+DAGS_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Only imported when they are used: exporting, fuzzy search, SASS, parsing the data files
+HEAVY_MODULES = ["sass", "selenium", "PIL", "fuzzywuzzy", "wakepy", "pandas", "numpy"]
+# Well above the ~0.15s it takes without the heavy modules, it took ~1s when they were imported on import
+MAX_IMPORT_SECONDS = 0.5
+
+
+def test_import_has_no_side_effects():
+    # In a new interpreter, so nothing is imported or built already
+    code = ("import json, sys; import geninfografia.generar_infografias as g; "
+            "print(json.dumps({'modules': sorted(set(sys.modules) & set(%r)), "
+            "'assets_built': g.build_assets.cache_info().currsize, "
+            "'config_read': g.get_custom_props.cache_info().currsize}))" % HEAVY_MODULES)
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=DAGS_DIR)
+    assert json.loads(result.stdout) == {"modules": [], "assets_built": 0, "config_read": 0}
+
+
+def test_import_time():
+    # The fastest of a few imports, the first one can be slower while the files are not in the OS cache
+    seconds = min(measure_import_time() for _ in range(3))
+    assert seconds < MAX_IMPORT_SECONDS
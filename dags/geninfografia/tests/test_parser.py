@@ -0,0 +1,77 @@
+import csv
+import random
+
+import pandas as pd
+import pytest
+
+from geninfografia.benchmark import generate_csv
+from geninfografia.utils.parser import Parser
+
+# Values the vectorized parsing has to handle like parse_number and parse_boolean
+EDGE_VALUES = ["nan", "NaN", "", " ", "-1.234", "-0,4", "999,6", "999,94", "999.999", "1_000", "1.234.567 €", "12 345",
+               "0", "-0", "1e3", "abc", "Si", "si", "SI", "No", "no", "Sí", "True", "<b>1</b>"]
+
+
+def parse_infografias_scalar(parser, data_file):
+    # The entities as the original parser built them, one cell at a time with parse_value
+    territories = parser.parse_territories()
+    df = pd.read_csv(data_file, encoding="utf-8")
+    columns = df.columns.tolist()
+    data = df.values
+    props = [columns[1]] + df[columns[1]].to_list()
+
+    entities = []
+    for entity_index, territory_code in enumerate(columns[4:]):
+        territory_code = territory_code.split(".")[0]
+        if territory_code not in territories:
+            continue
+        entity = {props[0]: territory_code, **territories[territory_code]}
+        for index, value in enumerate(data[:, entity_index + 4]):
+            prop_name = parser.replace_unallowed_symbols(str(props[index + 1]))
+            entity[prop_name] = str(parser.parse_value(prop_name, value))
+        entities.append(entity)
+    return entities
+
+
+@pytest.fixture(scope="module")
+def wide_csv(tmp_path_factory):
+    # Synthetic sheet with 500 entities, and the edge values mixed into the numeric and boolean properties
+    path = generate_csv(str(tmp_path_factory.mktemp("parser") / "datos entidades.csv"), 500, seed=1)
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        rows = list(csv.reader(file))
+    rng = random.Random(1)
+    parsed_props = Parser.int_properties | Parser.float_properties | Parser.boolean_properties
+    for row in rows[1:]:
+        if row[1] in parsed_props:
+            for column in rng.sample(range(4, len(row)), 40):
+                row[column] = rng.choice(EDGE_VALUES)
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        csv.writer(file).writerows(rows)
+    return path
+
+
+def test_parse_infografias_matches_scalar_parser(wide_csv):
+    parser = Parser()
+    expected = parse_infografias_scalar(parser, wide_csv)
+    assert len(expected) == 500
+    assert parser.parse_infografias(wide_csv) == expected
+
+
+def test_iter_infografias_matches_scalar_parser_in_chunks(wide_csv):
+    parser = Parser()
+    expected = parse_infografias_scalar(parser, wide_csv)
+    assert list(parser.iter_infografias(wide_csv, chunk_size=37)) == expected
+
+
+@pytest.mark.parametrize("number_type", [int, float])
+def test_parse_numbers_matches_parse_number(number_type):
+    parser = Parser()
+    values = EDGE_VALUES + ["1", "999", "1000", "1.000", "999.500", "1.000.000", "2.500.000.000", "-1.500", "0,05"]
+    parsed = parser.parse_numbers(pd.Series(values, dtype=object), number_type=number_type)
+    assert parsed.tolist() == [str(parser.parse_number(value, number_type=number_type)) for value in values]
+
+
+def test_parse_booleans_matches_parse_boolean():
+    parser = Parser()
+    parsed = parser.parse_booleans(pd.Series(EDGE_VALUES, dtype=object))
+    assert parsed.tolist() == [str(parser.parse_boolean(value)) for value in EDGE_VALUES]
@@ -0,0 +1,363 @@
+import io
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from .metrics import metrics, percentile
+
+
+@dataclass
+class Rendition:
+    # Downscaled copy of the PNG, saved in <output>/<name>/<territory>/<lang>/<filename>.<format>
+    name: str
+    width: int
+    format: str = "png"
+
+
+class ExportBackend:
+    """
+    Turns the HTML of an infographic into its PNG and PDF files. Every export worker opens its own session
+    with open() and uses it for all its infographics.
+
+    export() calls on_done once all the files are written. Backends that write them in the background return a
+    Future that completes after on_done, and finish the pending ones in shutdown().
+    """
+
+    name = None
+    # Charts are rendered as SVG when generating the HTML instead of by Highcharts in the browser
+    static_charts = False
+    # Errors after which the session is dropped and the infographic exported again
+    recoverable_errors = ()
+
+    def __init__(self, pngquant_path=None, renditions=()):
+        self.pngquant_path = pngquant_path
+        self.renditions = list(renditions)
+
+    def open(self, worker_id):
+        return None
+
+    def close(self, session):
+        pass
+
+    def export(self, session, input_file, filename, png_dir, pdf_dir, regenerate=False, percent=0, on_done=None,
+               rendition_paths=()):
+        # rendition_paths is a list of (rendition, path) with the renditions to save along with the PNG
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+    def summary(self):
+        # Optional stats printed once all the infographics are exported
+        return None
+
+
+class SeleniumBackend(ExportBackend):
+    """
+    Screenshots every infographic in a remote Chrome, the PDF is made from the screenshot. The screenshot is kept
+    in memory and the PNG optimization and the PDF are done by a pool of image workers, so the browser session
+    can go on with the next infographic meanwhile.
+    """
+
+    name = "selenium"
+
+    def __init__(self, selenium_urls, pngquant_path=None, render_timeout=10, image_workers=None, renditions=(),
+                 crop_selector=None):
+        from selenium.common.exceptions import WebDriverException
+
+        super().__init__(pngquant_path, renditions)
+        self.recoverable_errors = (WebDriverException,)
+        # When set the screenshot only covers this element instead of the whole window
+        self.crop_selector = crop_selector
+        self.selenium_urls = selenium_urls
+        self.render_timeout = float(render_timeout)
+        self.render_times = []
+        self.render_timeouts = 0
+        self._lock = threading.Lock()
+        image_workers = int(image_workers or os.cpu_count() or 1)
+        self.image_pool = ThreadPoolExecutor(max_workers=image_workers, thread_name_prefix="image")
+        # Screenshots waiting for an image worker, bounded so they do not pile up in memory
+        self._pending_images = threading.BoundedSemaphore(image_workers * 2)
+
+    def open(self, worker_id):
+        # Workers are spread over all the selenium hosts
+        return get_remote_driver(self.selenium_urls[worker_id % len(self.selenium_urls)])
+
+    def close(self, session):
+        quit_driver(session)
+
+    def export(self, session, input_file, filename, png_dir, pdf_dir, regenerate=False, percent=0, on_done=None,
+               rendition_paths=()):
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        png_path = f"{png_dir}/{filename}.png"
+        pdf_path = f"{pdf_dir}/{filename}.pdf"
+        if not regenerate:
+            if os.path.isfile(png_path):
+                print(f"[{round(percent)}%] Infografía [{png_path}] ya existe")
+                png_path = None
+            if os.path.isfile(pdf_path):
+                print(f"[{round(percent)}%] Infografía [{pdf_path}] ya existe")
+                pdf_path = None
+            rendition_paths = [(rendition, path) for rendition, path in rendition_paths if not os.path.isfile(path)]
+        if png_path is None and pdf_path is None and not rendition_paths:
+            if on_done is not None:
+                on_done()
+            return None
+
+        driver = session
+        driver.delete_all_cookies()
+        # driver.execute_cdp_cmd('Storage.clearDataForOrigin', {
+        #     "origin": '*',
+        #     "storageTypes": 'all',
+        # })
+
+        # ?export disables the chart animations, the page sets data-charts-rendered once all of them are drawn
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            with metrics.stage("page_load"):
+                driver.get(f"file://{input_file}?export")
+            with metrics.stage("chart_wait"):
+                WebDriverWait(driver, self.render_timeout, poll_frequency=0.05).until(charts_rendered)
+        except TimeoutException:
+            timed_out = True
+            metrics.count("chart_wait_timeouts")
+            print(f"Timeout esperando a que se dibujen los gráficos ({self.render_timeout}s).")
+        render_time = time.perf_counter() - start
+        with self._lock:
+            self.render_times.append(render_time)
+            self.render_timeouts += timed_out
+        print(f"Infografía [{filename}] renderizada en {render_time:.2f}s")
+        with metrics.stage("screenshot"):
+            driver.set_window_size(width=2480, height=3700)
+            if self.crop_selector:
+                # Only the infographic, without the empty part of the window below it
+                png_data = driver.find_element(By.CSS_SELECTOR, self.crop_selector).screenshot_as_png
+            else:
+                png_data = driver.get_screenshot_as_png()
+
+        self._pending_images.acquire()
+        try:
+            return self.image_pool.submit(self.save_images, png_data, png_path, pdf_path, rendition_paths, percent,
+                                          on_done)
+        except BaseException:
+            self._pending_images.release()
+            raise
+
+    def save_images(self, png_data, png_path, pdf_path, rendition_paths, percent, on_done):
+        try:
+            save_images(png_data, png_path, pdf_path, percent, self.pngquant_path, rendition_paths)
+        finally:
+            self._pending_images.release()
+        if on_done is not None:
+            on_done()
+
+    def shutdown(self):
+        self.image_pool.shutdown(wait=True)
+
+    def summary(self):
+        with self._lock:
+            render_times = sorted(self.render_times)
+        if not render_times:
+            return None
+        p50 = percentile(render_times, 0.50)
+        p95 = percentile(render_times, 0.95)
+        return (f"Tiempo de renderizado de {len(render_times)} infografías: p50 {p50:.2f}s, p95 {p95:.2f}s, "
+                f"máximo {render_times[-1]:.2f}s, {self.render_timeouts} timeouts")
+
+
+def charts_rendered(driver):
+    return driver.execute_script("return document.documentElement.getAttribute('data-charts-rendered') === 'true'")
+
+
+class WeasyprintBackend(ExportBackend):
+    """
+    Renders the infographics in process with WeasyPrint, without a browser. WeasyPrint does not run javascript,
+    so the templates draw the charts as SVG (static_charts). The PDF is vectorial and the PNG is rasterized from
+    it with pypdfium2, when it is installed.
+    """
+
+    name = "weasyprint"
+    static_charts = True
+    # Same page as the browser window used by selenium
+    page_css = "@page { size: 2480px 3508px; margin: 0 }"
+
+    def export(self, session, input_file, filename, png_dir, pdf_dir, regenerate=False, percent=0, on_done=None,
+               rendition_paths=()):
+        from weasyprint import HTML, CSS
+
+        os.makedirs(pdf_dir, exist_ok=True)
+        pdf_path = f"{pdf_dir}/{filename}.pdf"
+        png_path = f"{png_dir}/{filename}.png"
+        if regenerate or not os.path.isfile(pdf_path):
+            print(f"[{round(percent)}%] Exportando infografia en formato PDF [{pdf_path}]...")
+            with metrics.stage("weasyprint"):
+                HTML(filename=input_file).write_pdf(pdf_path, stylesheets=[CSS(string=self.page_css)])
+            metrics.count("pdf_bytes", os.path.getsize(pdf_path))
+            print(f"[{round(percent)}%] Infografía exportada a PDF [{pdf_path}]")
+        else:
+            print(f"[{round(percent)}%] Infografía [{pdf_path}] ya existe")
+
+        if regenerate or not os.path.isfile(png_path):
+            pdf2img(pdf_path, png_path, percent=percent, pngquant_path=self.pngquant_path)
+        else:
+            print(f"[{round(percent)}%] Infografía [{png_path}] ya existe")
+
+        if not regenerate:
+            rendition_paths = [(rendition, path) for rendition, path in rendition_paths if not os.path.isfile(path)]
+        if rendition_paths and os.path.isfile(png_path):
+            from PIL import Image
+
+            with Image.open(png_path) as image:
+                save_renditions(image, rendition_paths, percent, self.pngquant_path)
+        if on_done is not None:
+            on_done()
+
+
+EXPORT_BACKENDS = {backend.name: backend for backend in [SeleniumBackend, WeasyprintBackend]}
+
+
+def get_backend_class(name):
+    try:
+        return EXPORT_BACKENDS[name or SeleniumBackend.name]
+    except KeyError:
+        raise ValueError(f"Backend de exportación desconocido: {name}. Disponibles: {', '.join(EXPORT_BACKENDS)}")
+
+
+def get_selenium_urls(selenium_host, selenium_port):
+    # selenium_host can hold several comma separated hosts, optionally with their own port ("host1,host2:4445")
+    urls = []
+    for host in str(selenium_host).split(","):
+        host = host.strip()
+        if not host:
+            continue
+        if ":" not in host:
+            host = f"{host}:{selenium_port}"
+        urls.append(f"http://{host}/wd/hub")
+    return urls
+
+
+def get_remote_driver(selenium_url):
+    from selenium import webdriver
+
+    options = webdriver.ChromeOptions()
+    options.add_argument('--hide-scrollbars')
+    options.add_argument('--window-size=2480,3508')
+    options.add_experimental_option('excludeSwitches', ['enable-logging'])
+    options.add_argument('--log-level=3')
+
+    return webdriver.Remote(selenium_url, options=options)
+
+
+def quit_driver(driver):
+    from selenium.common.exceptions import WebDriverException
+
+    if driver is None:
+        return
+    try:
+        driver.quit()
+    except WebDriverException:
+        pass
+
+
+@metrics.timed("pdf2img")
+def pdf2img(pdf_path, img_path, percent=0, pngquant_path=None, scale=96 / 72):
+    # The default scale turns the PDF points back into CSS pixels
+    try:
+        import pypdfium2
+    except ImportError:
+        print("No es posible exportar la infografía a PNG sin un navegador: instala pypdfium2.")
+        return
+
+    os.makedirs(os.path.dirname(img_path), exist_ok=True)
+    print(f"[{round(percent)}%] Exportando infografia en formato PNG [{img_path}]...")
+    pdf = pypdfium2.PdfDocument(pdf_path)
+    try:
+        pdf[0].render(scale=scale).to_pil().save(img_path)
+    finally:
+        pdf.close()
+    optimize_png(img_path, pngquant_path)
+    print(f"[{round(percent)}%] Infografía exportada a PNG [{img_path}]")
+
+
+def save_images(png_data, png_path, pdf_path, percent=0, pngquant_path=None, rendition_paths=()):
+    # The screenshot is decoded once for the PDF and the renditions, and every file is written once
+    if png_path is not None:
+        os.makedirs(os.path.dirname(png_path), exist_ok=True)
+        print(f"[{round(percent)}%] Exportando infografia en formato PNG [{png_path}]...")
+        optimized_data = quantize_png(png_data, pngquant_path)
+        with open(png_path, "wb") as png_file:
+            png_file.write(optimized_data)
+        metrics.count("png_bytes", len(optimized_data))
+        print(f"[{round(percent)}%] Infografía exportada a PNG [{png_path}]")
+
+    if pdf_path is None and not rendition_paths:
+        return
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(png_data)).convert("RGB")
+
+    if pdf_path is not None:
+        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+        print(f"[{round(percent)}%] Exportando infografia en formato PDF [{pdf_path}]...")
+        with metrics.stage("img2pdf"):
+            image.save(pdf_path, optimize=True, quality=65)
+        metrics.count("pdf_bytes", os.path.getsize(pdf_path))
+        print(f"[{round(percent)}%] Infografía exportada a PDF [{pdf_path}]")
+
+    if rendition_paths:
+        save_renditions(image, rendition_paths, percent, pngquant_path)
+
+
+@metrics.timed("renditions")
+def save_renditions(image, rendition_paths, percent=0, pngquant_path=None):
+    from PIL import Image
+
+    for rendition, path in rendition_paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        height = round(image.height * rendition.width / image.width)
+        resized = image.convert("RGB").resize((rendition.width, height), Image.LANCZOS)
+        if rendition.format == "png":
+            buffer = io.BytesIO()
+            resized.save(buffer, format="PNG")
+            with open(path, "wb") as rendition_file:
+                rendition_file.write(quantize_png(buffer.getvalue(), pngquant_path))
+        else:
+            pil_format = "JPEG" if rendition.format in ("jpg", "jpeg") else rendition.format.upper()
+            resized.save(path, format=pil_format, quality=80)
+        print(f"[{round(percent)}%] Infografía exportada a {rendition.format.upper()} de {rendition.width}px [{path}]")
+
+
+@metrics.timed("pngquant")
+def quantize_png(png_data, pngquant_path):
+    # pngquant reads the image from stdin and writes the optimized one to stdout, without temporary files
+    if not pngquant_path:
+        print("No es posible optimizar la imagen")
+        print("- Añade la ubicación de pngquant en el archivo config.yaml usando la propiedad PNGQUANT_PATH.")
+        print("Puedes descargarlo en https://pngquant.org/")
+        return png_data
+    try:
+        result = subprocess.run([pngquant_path, "--quality=85-85", "--speed=3", "-"], input=png_data,
+                                capture_output=True)
+    except OSError as e:
+        print(f"No es posible optimizar la imagen con {pngquant_path}: {e}")
+        return png_data
+    # pngquant fails when the image can not be optimized with that quality, the original is kept then
+    if result.returncode != 0 or not result.stdout:
+        return png_data
+    return result.stdout
+
+
+def optimize_png(img_path, pngquant_path):
+    with open(img_path, "rb") as img_file:
+        png_data = img_file.read()
+    optimized_data = quantize_png(png_data, pngquant_path)
+    if optimized_data is not png_data:
+        with open(img_path, "wb") as img_file:
+            img_file.write(optimized_data)
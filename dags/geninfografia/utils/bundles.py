@@ -0,0 +1,93 @@
+import io
+import os
+import tarfile
+import zipfile
+
+
+class PdfBundleWriter:
+    """
+    Multi-page PDF with one full-page JPEG per image, written to disk page by page so only one image is decoded
+    at a time. Pages have the size of the images in points, like the PDFs of every infographic.
+    """
+
+    def __init__(self, path, quality=65):
+        self.path = path
+        self.quality = quality
+        self.file = open(path, "wb")
+        self.offsets = {}
+        self.page_ids = []
+        # 1 is the catalog and 2 the page tree, written at the end once all the pages are known
+        self.next_id = 3
+        self.file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def add_image(self, image_path):
+        from PIL import Image
+
+        with Image.open(image_path) as image:
+            width, height = image.size
+            jpeg = io.BytesIO()
+            image.convert("RGB").save(jpeg, format="JPEG", quality=self.quality, optimize=True)
+
+        image_id, contents_id, page_id = self.next_id, self.next_id + 1, self.next_id + 2
+        self.next_id += 3
+        self.write_object(image_id, (f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                                     f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode "
+                                     f"/Length {jpeg.getbuffer().nbytes} >>").encode(), jpeg.getvalue())
+        contents = f"q {width} 0 0 {height} 0 0 cm /Im0 Do Q".encode()
+        self.write_object(contents_id, f"<< /Length {len(contents)} >>".encode(), contents)
+        self.write_object(page_id, (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] "
+                                    f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> "
+                                    f"/Contents {contents_id} 0 R >>").encode())
+        self.page_ids.append(page_id)
+
+    def write_object(self, object_id, dictionary, stream=None):
+        self.offsets[object_id] = self.file.tell()
+        self.file.write(f"{object_id} 0 obj\n".encode() + dictionary)
+        if stream is not None:
+            self.file.write(b"\nstream\n" + stream + b"\nendstream")
+        self.file.write(b"\nendobj\n")
+
+    def close(self):
+        kids = " ".join(f"{page_id} 0 R" for page_id in self.page_ids)
+        self.write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>".encode())
+        self.write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref_offset = self.file.tell()
+        self.file.write(f"xref\n0 {self.next_id}\n0000000000 65535 f \n".encode())
+        for object_id in range(1, self.next_id):
+            self.file.write(f"{self.offsets[object_id]:010d} 00000 n \n".encode())
+        self.file.write(f"trailer\n<< /Size {self.next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+        self.file.close()
+
+
+def write_pdf_bundle(image_paths, pdf_path, quality=65):
+    tmp_path = f"{pdf_path}.tmp"
+    with PdfBundleWriter(tmp_path, quality) as writer:
+        for image_path in image_paths:
+            writer.add_image(image_path)
+    os.replace(tmp_path, pdf_path)
+
+
+def write_archive(files, archive_path, archive_format="zip"):
+    # files is a list of (path, name in the archive). PNG and PDF are already compressed, so they are only stored
+    tmp_path = f"{archive_path}.tmp"
+    if archive_format == "zip":
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for path, name in files:
+                archive.write(path, name)
+    elif archive_format == "tar":
+        with tarfile.open(tmp_path, "w") as archive:
+            for path, name in files:
+                archive.add(path, name)
+    else:
+        raise ValueError(f"Formato de archivo desconocido: {archive_format}")
+    os.replace(tmp_path, archive_path)
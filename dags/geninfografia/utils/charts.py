@@ -0,0 +1,70 @@
+import math
+from html import escape
+
+from markupsafe import Markup
+
+
+def parse_chart_value(value):
+    try:
+        return float(str(value).replace(',', '.'))
+    except ValueError:
+        return 0
+
+
+def pie_chart_svg(data, start_angle=0, label_format="{value}%", width=1000, height=400):
+    """
+    Pie chart rendered as inline SVG, used instead of Highcharts when the export backend does not run javascript.
+    data is a list of (name, value, color) and start_angle is in degrees clockwise from the top, like in Highcharts.
+    """
+    data = [(name, parse_chart_value(value), color) for name, value, color in data]
+    total = sum(value for _, value, _ in data if value > 0)
+
+    cx, cy = width / 2, height / 2
+    radius = height * 0.42
+    elements = []
+    if total:
+        angle = float(start_angle)
+        for name, value, color in data:
+            if value <= 0:
+                continue
+            sweep = 360 * value / total
+            elements.append(pie_slice(cx, cy, radius, angle, sweep, color))
+            elements.append(pie_label(cx, cy, radius, angle + sweep / 2, name, value, label_format))
+            angle += sweep
+
+    svg = (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" width="100%" '
+           f'style="overflow: visible">{"".join(elements)}</svg>')
+    return Markup(svg)
+
+
+def polar(cx, cy, radius, angle):
+    radians = math.radians(angle - 90)
+    return cx + radius * math.cos(radians), cy + radius * math.sin(radians)
+
+
+def pie_slice(cx, cy, radius, angle, sweep, color):
+    if sweep >= 360:
+        return f'<circle cx="{cx:.2f}" cy="{cy:.2f}" r="{radius:.2f}" fill="{color}"/>'
+    x1, y1 = polar(cx, cy, radius, angle)
+    x2, y2 = polar(cx, cy, radius, angle + sweep)
+    large_arc = 1 if sweep > 180 else 0
+    return (f'<path d="M {cx:.2f} {cy:.2f} L {x1:.2f} {y1:.2f} '
+            f'A {radius:.2f} {radius:.2f} 0 {large_arc} 1 {x2:.2f} {y2:.2f} Z" fill="{color}"/>')
+
+
+def pie_label(cx, cy, radius, angle, name, value, label_format):
+    # Connector from the slice edge to a horizontal line with the label on top, on the side of the slice
+    edge_x, edge_y = polar(cx, cy, radius, angle)
+    elbow_x, elbow_y = polar(cx, cy, radius * 1.12, angle)
+    right = edge_x >= cx
+    end_x = cx + (radius * 1.5 if right else -radius * 1.5)
+    anchor = "end" if right else "start"
+    value_text = label_format.format(value=f"{value:g}".replace('.', ','))
+
+    return (f'<polyline points="{edge_x:.2f},{edge_y:.2f} {elbow_x:.2f},{elbow_y:.2f} {end_x:.2f},{elbow_y:.2f}" '
+            f'fill="none" stroke="#000000" stroke-width="1"/>'
+            f'<text x="{end_x:.2f}" y="{elbow_y - 8:.2f}" text-anchor="{anchor}" '
+            f'font-family="Source Sans Pro, sans-serif" fill="#000000">'
+            f'<tspan x="{end_x:.2f}" dy="-1.1em" font-size="28">{escape(value_text)}</tspan>'
+            f'<tspan x="{end_x:.2f}" dy="1.1em" font-size="18">{escape(str(name))}</tspan>'
+            f'</text>')
@@ -0,0 +1,85 @@
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class EntityInfo:
+    # Column of the entity in the data file, and the properties it is looked up by
+    column: int
+    territory: str
+    nif: str
+    name: str
+
+
+def normalize_name(name):
+    # Lowercase words without accents or punctuation, sorted like fuzz.token_sort_ratio does
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii").lower()
+    return " ".join(sorted(re.findall(r"\w+", name)))
+
+
+def get_trigrams(text):
+    text = f"  {text} "
+    return {text[index:index + 3] for index in range(len(text) - 2)}
+
+
+class EntityIndex:
+    """
+    Entities of a data file by NIF, normalized name and territory, so a single entity is found without going
+    through all of them. Names are also indexed by trigram: the fuzzy search only scores the entities that share
+    the most trigrams with the name searched.
+    """
+
+    def __init__(self, entities=()):
+        self.entities = []
+        self.by_nif = defaultdict(list)
+        self.by_name = defaultdict(list)
+        self.by_territory = defaultdict(list)
+        self.by_trigram = defaultdict(list)
+        for entity in entities:
+            self.add(entity)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def add(self, entity):
+        position = len(self.entities)
+        self.entities.append(entity)
+        normalized_name = normalize_name(entity.name)
+        self.by_nif[entity.nif].append(position)
+        self.by_name[normalized_name].append(position)
+        self.by_territory[entity.territory.upper()].append(position)
+        for trigram in get_trigrams(normalized_name):
+            self.by_trigram[trigram].append(position)
+
+    def get_by_nif(self, nif):
+        return [self.entities[position] for position in self.by_nif.get(nif, ())]
+
+    def get_by_name(self, name):
+        return [self.entities[position] for position in self.by_name.get(normalize_name(name), ())]
+
+    def get_by_territory(self, territory):
+        return [self.entities[position] for position in self.by_territory.get(territory.upper(), ())]
+
+    def search(self, name, limit=3, candidates=50):
+        """
+        Best limit entities for name as (entity, score), with the score of fuzz.token_sort_ratio. Entities with the
+        same name are only returned once.
+        """
+        from fuzzywuzzy import fuzz
+
+        normalized_name = normalize_name(name)
+        shared_trigrams = Counter()
+        for trigram in get_trigrams(normalized_name):
+            shared_trigrams.update(self.by_trigram.get(trigram, ()))
+        positions = [position for position, _ in shared_trigrams.most_common(candidates)]
+        # Exact matches are always scored, even when many other names share the same trigrams
+        positions.extend(position for position in self.by_name.get(normalized_name, ()) if position not in positions)
+
+        matches = {}
+        for position in positions:
+            entity = self.entities[position]
+            if entity.name not in matches:
+                matches[entity.name] = (entity, fuzz.token_sort_ratio(name, entity.name))
+        return sorted(matches.values(), key=lambda match: match[1], reverse=True)[:limit]
@@ -0,0 +1,31 @@
+import contextlib
+import os
+import uuid
+
+
+def get_tmp_path(path):
+    # Unique, so concurrent tasks never write to the same temporary file, and hidden, so it is not taken for a
+    # static file while it is being written
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, f".{filename}.{uuid.uuid4().hex}.tmp")
+
+
+def remove_file(path):
+    # Another task can have removed it already
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w", encoding="utf-8"):
+    """
+    Opens a temporary file that replaces path at once when it is closed without errors, so path is never read
+    half written. With several writers at the same time the last one wins.
+    """
+    tmp_path = get_tmp_path(path)
+    try:
+        with open(tmp_path, mode, encoding=None if "b" in mode else encoding) as file:
+            yield file
+        os.replace(tmp_path, path)
+    finally:
+        remove_file(tmp_path)
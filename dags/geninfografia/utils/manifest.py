@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import threading
+
+from .files import atomic_write
+
+
+def hash_data(*items):
+    # Items can be bytes, strings or JSON serializable dicts
+    digest = hashlib.sha256()
+    for item in items:
+        if isinstance(item, dict):
+            item = json.dumps(item, sort_keys=True, ensure_ascii=False, default=str)
+        if isinstance(item, str):
+            item = item.encode("utf-8")
+        digest.update(hashlib.sha256(item).digest())
+    return digest.hexdigest()
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Hash of the inputs used to generate every output file, kept between runs so
+    outputs whose inputs did not change are not generated again.
+
+    The outputs generated are also kept as pending until remove_pending is called
+    once they are uploaded, so a failed upload is retried by the next run even if
+    the outputs are up to date by then.
+    """
+
+    filename = "manifest.json"
+
+    def __init__(self, root, filename=None):
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(root, filename or self.filename)
+        self.pending_path = f"{os.path.splitext(self.path)[0]}.pending.json"
+        self.entries = {}
+        self.changed = set()
+        self.pending = set()
+        self._lock = threading.Lock()
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.entries = json.load(file)
+        except FileNotFoundError:
+            pass
+        try:
+            with open(self.pending_path, "r", encoding="utf-8") as file:
+                self.pending = set(json.load(file))
+        except FileNotFoundError:
+            pass
+
+    def key(self, output):
+        return os.path.relpath(output, self.root).replace(os.sep, "/")
+
+    def get(self, output):
+        with self._lock:
+            return self.entries.get(self.key(output))
+
+    def is_current(self, output, digest):
+        return digest is not None and self.get(output) == digest and os.path.isfile(output)
+
+    def update(self, output, digest):
+        key = self.key(output)
+        with self._lock:
+            self.entries[key] = digest
+            self.changed.add(key)
+
+    def get_pending(self):
+        # Outputs generated in this run or in a previous one that are not uploaded yet
+        with self._lock:
+            return sorted(self.pending | self.changed)
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        with self._lock:
+            # The pending outputs are saved first, an output is never current without being pending or uploaded
+            self.pending |= self.changed
+            self.save_pending()
+            with atomic_write(self.path) as file:
+                json.dump(self.entries, file, ensure_ascii=False, indent=1, sort_keys=True)
+
+    def remove_pending(self, outputs):
+        # Called with the keys of the outputs once they are uploaded
+        with self._lock:
+            self.pending -= set(outputs)
+            self.changed -= set(outputs)
+            self.save_pending()
+
+    def save_pending(self):
+        if self.pending:
+            with atomic_write(self.pending_path) as file:
+                json.dump(sorted(self.pending), file, ensure_ascii=False, indent=1)
+        elif os.path.isfile(self.pending_path):
+            os.remove(self.pending_path)
@@ -0,0 +1,109 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return 0
+    return values[int(fraction * (len(values) - 1))]
+
+
+class Metrics:
+    """
+    Durations of every stage of the pipeline and counters (entities, bytes, retries, cache hits...), shared by
+    all the threads of the process. Stages are measured with the stage() context manager or the timed() decorator.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.durations.clear()
+            self.counters.clear()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.durations[name].append(seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def summary(self):
+        with self._lock:
+            durations = {name: sorted(values) for name, values in self.durations.items()}
+            counters = dict(self.counters)
+        stages = {}
+        for name, values in durations.items():
+            stages[name] = {
+                "count": len(values),
+                "total": round(sum(values), 4),
+                "p50": round(percentile(values, 0.50), 4),
+                "p95": round(percentile(values, 0.95), 4),
+                "max": round(values[-1], 4),
+            }
+        return {"stages": stages, "counters": counters}
+
+    def log_summary(self, summary=None):
+        summary = summary or self.summary()
+        for name, stage in sorted(summary["stages"].items(), key=lambda item: -item[1]["total"]):
+            logger.info(f"[{name}] {stage['count']} veces, total {stage['total']:.2f}s, p50 {stage['p50']:.3f}s, "
+                        f"p95 {stage['p95']:.3f}s, máximo {stage['max']:.3f}s")
+        for name, value in sorted(summary["counters"].items()):
+            logger.info(f"[{name}] {value}")
+
+    def save(self, path, summary=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(summary or self.summary(), file, ensure_ascii=False, indent=1, sort_keys=True)
+
+
+def merge_summaries(summaries):
+    # Summaries of several processes or tasks. Their percentiles can not be combined, the worst one is kept
+    merged = {"stages": {}, "counters": defaultdict(int)}
+    for summary in summaries:
+        if not summary:
+            continue
+        for name, stage in summary["stages"].items():
+            merged_stage = merged["stages"].setdefault(name, {"count": 0, "total": 0, "p50": 0, "p95": 0, "max": 0})
+            merged_stage["count"] += stage["count"]
+            merged_stage["total"] = round(merged_stage["total"] + stage["total"], 4)
+            for key in ("p50", "p95", "max"):
+                merged_stage[key] = max(merged_stage[key], stage[key])
+        for name, value in summary["counters"].items():
+            merged["counters"][name] += value
+    merged["counters"] = dict(merged["counters"])
+    return merged
+
+
+# Metrics of the current process
+metrics = Metrics()
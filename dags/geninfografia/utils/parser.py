@@ -1,63 +1,135 @@
+import csv
 import os
+import numpy as np
 import pandas as pd
 import logging
 logger = logging.getLogger(__name__)
 
-class Parser:
+from .entity_index import EntityInfo
+from .metrics import metrics
 
-    info_properties = ["Codigo Territorio", "código entidad", "Correo electrónico", "Público?",
-                       "Idioma", "auditoria/balance", "Logo", "NIF", "Nombre"]
+class Parser:
 
-    ignore_properties = ["nan", "Código", "titulo de la lista", "titulo del gráfico", "titulo del gráfico"]
+    info_properties = frozenset(["Codigo Territorio", "código entidad", "Correo electrónico", "Público?",
+                                 "Idioma", "auditoria/balance", "Logo", "NIF", "Nombre"])
 
-    int_properties = ["ind3d", "ind3h", "ind3a", "ind20d", "ind2",
-                      "ind97", "q1203", "q1201", "q1405",
-                      "q1406", "q1413", "ind254", "ind6",
-                      "ind7", "ind67agru", "ind1d", "ind1h", "ind1a",
+    ignore_properties = frozenset(["nan", "Código", "titulo de la lista", "titulo del gráfico", "titulo del gráfico"])
 
-                      "ind1agrupado", "ind1agrupadod", "ind1agrupadoh", "ind1agrupadoa",
-                      "ind118", "q1203", "q1201", "ind254A"]
+    int_properties = frozenset(["ind3d", "ind3h", "ind3a", "ind20d", "ind2",
+                                "ind97", "q1203", "q1201", "q1405",
+                                "q1406", "q1413", "ind254", "ind6",
+                                "ind7", "ind67agru", "ind1d", "ind1h", "ind1a",
 
-    float_properties = []
+                                "ind1agrupado", "ind1agrupadod", "ind1agrupadoh", "ind1agrupadoa",
+                                "ind118", "q1203", "q1201", "ind254A"])
 
-    boolean_properties = ["ind58", "ind62", "q4104a", "q4104b", "q4104c",
-                          "q4104d", "q5305a", "q5305b", "q5305c",
-                          "q5305d", "ind71", "ind105", "ind78", "ind80",
+    float_properties = frozenset()
 
-                          "q3406c", "q3406a", "q3406d", "q5305a", "q5305b",
-                          "q5305c", "q5305d", "ind71", "q4106a", "q4106d",
-                          "q4106c", "ind62agrupado", "q6813a", "q6813b",
-                          "q6813c", "q6813d", "q1415e", "q1415f", "q1415a"]
+    boolean_properties = frozenset(["ind58", "ind62", "q4104a", "q4104b", "q4104c",
+                                    "q4104d", "q5305a", "q5305b", "q5305c",
+                                    "q5305d", "ind71", "ind105", "ind78", "ind80",
 
-    combined_properties = ["ind27", "q0107", "q0101agrupada"] # Can be both numeric or text
+                                    "q3406c", "q3406a", "q3406d", "q5305a", "q5305b",
+                                    "q5305c", "q5305d", "ind71", "q4106a", "q4106d",
+                                    "q4106c", "ind62agrupado", "q6813a", "q6813b",
+                                    "q6813c", "q6813d", "q1415e", "q1415f", "q1415a"])
 
-    def parse_infografias(self, data_file):
-        territories = self.parse_territories()
-        df = pd.read_csv(data_file, encoding="utf-8")
-        columns = df.columns.tolist()
-        data = df.values
+    combined_properties = frozenset(["ind27", "q0107", "q0101agrupada"]) # Can be both numeric or text
 
-        props = [columns[1]] + df[columns[1]].to_list()
-        self.validate_props(props)
-
-        entities = []
-        for entity_index, territory_code in enumerate(columns[4:]):
-            try:
-                territory_code = territory_code.split(".")[0]
-                entity_data = data[:, entity_index + 4]  # Get all rows for a specific entity
-                entity = {props[0]: territory_code, **territories[territory_code]}
+    number_cleanup = str.maketrans({" ": None, "€": None, ".": None, ",": "."})
 
-                for index, value in enumerate(list(entity_data)):
-                    prop_name = str(props[index + 1])
-                    prop_name = self.replace_unallowed_symbols(prop_name)
-                    value = self.parse_value(prop_name, value)
-                    entity[prop_name] = str(value)
+    # Entity columns read from the data file at a time, so the memory used does not grow with the number of entities
+    chunk_size = 2000
 
-                entities.append(entity)
-            except KeyError:
-                pass
+    def parse_infografias(self, data_file, only_territories=None):
+        return list(self.iter_infografias(data_file, only_territories))
 
-        return entities
+    def iter_infografias(self, data_file, only_territories=None, chunk_size=None, columns=None):
+        """
+        Yields the entities of data_file one at a time. The entity columns are read chunk_size at a time, so
+        the first entities are available before the whole file is parsed. columns limits them to the entities
+        in those column indexes, like EntityInfo.column.
+        """
+        chunk_size = int(chunk_size or self.chunk_size)
+        territories = self.parse_territories()
+        header = self.read_header(data_file)
+        entity_columns = self.get_entity_columns(data_file, only_territories, territories, header)
+        if columns is not None:
+            columns = set(columns)
+            entity_columns = [(index, territory_code) for index, territory_code in entity_columns if index in columns]
+        if not entity_columns:
+            self.validate_props([header[1]] + pd.read_csv(data_file, encoding="utf-8", usecols=[1]).iloc[:, 0].to_list())
+            return
+
+        prop_names = None
+        for start in range(0, len(entity_columns), chunk_size):
+            chunk = entity_columns[start:start + chunk_size]
+            with metrics.stage("parse_chunk"):
+                # The property names are read with every chunk, every read goes through the whole file anyway
+                df = pd.read_csv(data_file, encoding="utf-8", usecols=[1] + [index for index, _ in chunk], dtype=str)
+                if prop_names is None:
+                    props = [header[1]] + df.iloc[:, 0].to_list()
+                    self.validate_props(props)
+                    prop_names = [self.replace_unallowed_symbols(prop) for prop in props[1:]]
+
+                # One row per property and one column per entity, already as text
+                values = df.iloc[:, 1:].astype(str).to_numpy(dtype=object)
+                del df
+                self.parse_rows(values, prop_names, self.int_properties, lambda rows: self.parse_numbers(rows, number_type=int))
+                self.parse_rows(values, prop_names, self.float_properties, lambda rows: self.parse_numbers(rows, number_type=float))
+                self.parse_rows(values, prop_names, self.boolean_properties, self.parse_booleans)
+                entity_values = values.T.tolist()
+                del values
+            metrics.count("entities", len(chunk))
+
+            for (_, territory_code), values in zip(chunk, entity_values):
+                entity = {props[0]: territory_code, **territories[territory_code]}
+                entity.update(zip(prop_names, values))
+                yield entity
+
+    def get_entity_columns(self, data_file, only_territories=None, territories=None, header=None):
+        # (column index, territory code) of every entity. Entities from unknown territories, or not in
+        # only_territories when given, are skipped
+        territories = territories if territories is not None else self.parse_territories()
+        header = header or self.read_header(data_file)
+        entity_columns = []
+        for entity_index, territory_code in enumerate(header[4:]):
+            territory_code = territory_code.split(".")[0]
+            if territory_code in territories and (not only_territories or territory_code.upper() in only_territories):
+                entity_columns.append((entity_index + 4, territory_code))
+        return entity_columns
+
+    def parse_entity_info(self, data_file, only_territories=None):
+        # Name and NIF of every entity, for EntityIndex. Only those two rows are kept, without parsing the rest
+        territories = self.parse_territories()
+        rows = {}
+        with open(data_file, "r", encoding="utf-8", newline="") as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            for row in reader:
+                if len(row) > 1 and row[1] in ("Nombre", "NIF"):
+                    rows[row[1]] = row
+                    if len(rows) == 2:
+                        break
+
+        def get_value(prop, index):
+            row = rows.get(prop, [])
+            return row[index] if index < len(row) else ""
+
+        return [EntityInfo(index, territory_code, get_value("NIF", index), get_value("Nombre", index))
+                for index, territory_code in self.get_entity_columns(data_file, only_territories, territories, header)]
+
+    def read_header(self, data_file):
+        with open(data_file, "r", encoding="utf-8", newline="") as file:
+            return next(csv.reader(file))
+
+    def parse_rows(self, values, prop_names, properties, parse_function):
+        rows = [index for index, prop_name in enumerate(prop_names) if prop_name in properties]
+        if not rows:
+            return
+        group = values[rows]
+        parsed = parse_function(pd.Series(group.ravel(), dtype=object))
+        values[rows] = parsed.to_numpy(dtype=object).reshape(group.shape)
 
     def parse_territories(self):
         datos_territorios_dir = os.path.join(os.path.dirname(__file__), "..", "data", "datos_territorios.csv")
@@ -75,7 +147,7 @@ class Parser:
         return territories
 
     def validate_props(self, props):
-        all_properties = self.info_properties + self.int_properties + self.float_properties + self.boolean_properties + self.combined_properties + self.ignore_properties
+        all_properties = self.info_properties | self.int_properties | self.float_properties | self.boolean_properties | self.combined_properties | self.ignore_properties
         for prop in props:
             if prop not in all_properties:
                 logger.warning(f"La propiedad '{prop}' no está registrada y puede causar errores.")
@@ -116,6 +188,44 @@ class Parser:
 
         return f"{formatted_value}{suffixes[suffix_index]}"
 
+    def parse_numbers(self, values, number_type):
+        """Vectorized parse_number for a Series of strings. Returns a Series of strings."""
+        suffixes = np.array(["", "<small>{{ TXT059 }}</small>", "M"], dtype=object)
+
+        # Same replacements as parse_number in a single pass
+        cleaned = values.str.translate(self.number_cleanup)
+
+        numbers = pd.to_numeric(cleaned, errors="coerce").to_numpy(dtype=float)
+        parsed = ~np.isnan(numbers)
+        # to_numeric is stricter than float() (e.g. "nan" or "1_000"), retry those cells one by one
+        cleaned_values = cleaned.to_numpy(dtype=object)
+        for index in np.flatnonzero(~parsed):
+            try:
+                numbers[index] = float(cleaned_values[index])
+                parsed[index] = True
+            except ValueError:
+                pass
+
+        if number_type is int:
+            # + 0.0 turns -0.0 into 0.0, as round() returns an int
+            numbers = np.round(numbers) + 0.0
+
+        suffix_index = np.zeros(len(numbers), dtype=int)
+        for _ in range(len(suffixes) - 1):
+            is_big = numbers >= 1000
+            numbers = np.where(is_big, numbers / 1000, numbers)
+            suffix_index += is_big
+
+        formatted = pd.Series(np.char.mod("%.1f", numbers).astype(object), index=values.index)
+        # Thousands separator, only needed for negative numbers and those that round up to 1000 or more
+        has_thousands = np.abs(numbers) >= 999
+        formatted[has_thousands] = formatted[has_thousands].str.replace(r"(\d)(?=(\d{3})+\.)", r"\1,", regex=True)
+        formatted = formatted.str.rstrip('0').str.rstrip('.').str.replace('.', ',', regex=False)
+        formatted = formatted + suffixes[suffix_index]
+
+        # Values that can not be parsed are kept as the cleaned string
+        return formatted.where(parsed, cleaned)
+
     def parse_boolean(self, value):
         if str(value).lower() == "si":
             return True
@@ -124,5 +234,10 @@ class Parser:
         else:
             return value
 
+    def parse_booleans(self, values):
+        """Vectorized parse_boolean for a Series of strings. Returns a Series of strings."""
+        lower = values.str.lower()
+        return values.mask(lower == "si", "True").mask(lower == "no", "False")
+
     def replace_unallowed_symbols(self, prop_name):
         return str(prop_name).replace("/", "_")
\ No newline at end of file
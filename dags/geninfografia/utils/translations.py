@@ -1,9 +1,11 @@
+import hashlib
 import os
-import pandas as pd
 import json
 
 from dataclasses import dataclass
 
+from .files import atomic_write
+
 @dataclass
 class Lang:
     # Column names in strings.csv translations file
@@ -13,7 +15,9 @@ class Lang:
 
 class Translations:
     translations_dir = os.path.join(os.path.dirname(__file__), "..", "translations")
-    df = pd.read_csv(f"{translations_dir}/strings.csv")
+    strings_file = os.path.join(translations_dir, "strings.csv")
+    # sha256 of the strings.csv used to generate the current JSON files
+    hash_file = os.path.join(translations_dir, ".strings.csv.sha256")
 
     CAS = Lang('cas', "Castellano")
     CAT = Lang('cat', "Català")
@@ -22,13 +26,40 @@ class Translations:
     AST = Lang('ast', "Asturianu")
     EN = Lang('en', "English")
 
-    def generate_translations(self, langs=None):
+    def generate_translations(self, langs=None, force=False):
         if not langs:
             langs = [self.CAS, self.CAT, self.EUS, self.GAL, self.AST, self.EN]
 
+        # JSON files are only generated again when strings.csv changes
+        strings_hash = self.get_strings_hash()
+        if not force and strings_hash == self.get_generated_hash() and \
+                all(os.path.isfile(self.get_translations_file(lang.code)) for lang in langs):
+            return
+
+        import pandas as pd
+
+        df = pd.read_csv(self.strings_file)
         for lang in langs:
-            output_filename = f"{self.translations_dir}/{lang.code}.json"
-            data = dict(zip(self.df['Código'], self.df[lang.name].str.strip()))
+            output_filename = self.get_translations_file(lang.code)
+            data = dict(zip(df['Código'], df[lang.name].str.strip()))
 
-            with open(output_filename, 'w', encoding='utf-8') as file:
+            # Replaced at once, other tasks can be reading the translations while they are generated
+            with atomic_write(output_filename) as file:
                 json.dump(data, file, ensure_ascii=False, indent=4)
+
+        with atomic_write(self.hash_file) as file:
+            file.write(strings_hash)
+
+    def get_strings_hash(self):
+        with open(self.strings_file, 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    def get_generated_hash(self):
+        try:
+            with open(self.hash_file, 'r', encoding='utf-8') as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def get_translations_file(self, lang_code):
+        return os.path.join(self.translations_dir, f"{lang_code}.json")
@@ -0,0 +1,34 @@
+"""
+Failure emails of the DAGs. The recipients are read from the mail_zulip Variable when a task fails, not every
+time the scheduler parses the DAG files.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+EMAIL_VARIABLE = "mail_zulip"
+
+
+def notify_failure(context):
+    """
+    on_failure_callback that sends the same email as email_on_failure to the mail_zulip Variable.
+    """
+    from airflow.models import Variable
+    from airflow.utils.email import send_email
+
+    task_instance = context["task_instance"]
+    email = Variable.get(EMAIL_VARIABLE, default_var=None)
+    if not email:
+        logger.warning(f"No {EMAIL_VARIABLE} Variable, the failure of {task_instance.task_id} is not emailed")
+        return
+    subject, html_content, _ = task_instance.get_email_subject_content(context.get("exception"),
+                                                                       task=context["task"])
+    try:
+        send_email(email, subject, html_content)
+    except Exception:
+        # As with email_on_failure, the task fails anyway
+        logger.exception(f"Could not send the failure email of {task_instance.task_id}")
+
+
+# default_args of the DAGs that email their failures
+FAILURE_EMAIL_ARGS = {"email_on_failure": False, "on_failure_callback": notify_failure}
@@ -0,0 +1,88 @@
+"""
+Time it takes the scheduler to parse every DAG file, and the metadata DB queries it makes while parsing them.
+The DAG files are parsed again and again, they should not query the DB (Variables, Connections) at import.
+
+    python parse_benchmark.py --repeat 5
+
+Run it from the dags directory, in an environment with Airflow and its metadata DB configured. The exit code is
+1 when a DAG file queries the DB or fails to import.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+DAGS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_ignore_patterns():
+    # Patterns of .airflowignore, regular expressions matched against the path relative to the dags directory
+    try:
+        with open(os.path.join(DAGS_DIR, ".airflowignore"), "r", encoding="utf-8") as file:
+            lines = [line.split("#", 1)[0].strip() for line in file]
+    except FileNotFoundError:
+        return []
+    return [re.compile(line) for line in lines if line]
+
+
+def get_dag_files():
+    # The files the scheduler parses: the ones not in .airflowignore that, like in its safe mode, mention both
+    # airflow and dag
+    ignore_patterns = get_ignore_patterns()
+    dag_files = []
+    for filename in sorted(os.listdir(DAGS_DIR)):
+        path = os.path.join(DAGS_DIR, filename)
+        if filename.endswith(".py") and filename != os.path.basename(__file__) and \
+                not any(pattern.search(filename) for pattern in ignore_patterns):
+            with open(path, "r", encoding="utf-8") as file:
+                content = file.read().lower()
+            if "airflow" in content and "dag" in content:
+                dag_files.append(path)
+    return dag_files
+
+
+def parse_dag_file(path, repeat):
+    from airflow import settings
+    from airflow.models import DagBag
+    from sqlalchemy import event
+
+    queries = []
+
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(settings.engine, "before_cursor_execute", count_query)
+    try:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            dag_bag = DagBag(dag_folder=path, include_examples=False, safe_mode=False)
+            timings.append(time.perf_counter() - start)
+    finally:
+        event.remove(settings.engine, "before_cursor_execute", count_query)
+    return {"file": os.path.basename(path), "dags": len(dag_bag.dags), "errors": dag_bag.import_errors,
+            "seconds": min(timings), "queries": len(queries) // repeat, "statements": sorted(set(queries))}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse time and metadata DB queries of the DAG files")
+    parser.add_argument("files", nargs="*", help="DAG files to parse, all of the dags directory by default")
+    parser.add_argument("--repeat", type=int, default=3, help="Times every file is parsed, the fastest one is shown")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for path in args.files or get_dag_files():
+        result = parse_dag_file(os.path.abspath(path), max(1, args.repeat))
+        print(f"{result['file']}: {result['dags']} DAGs, {result['seconds'] * 1000:.1f}ms, "
+              f"{result['queries']} DB queries")
+        for statement in result["statements"]:
+            print(f"    {' '.join(statement.split())}")
+        for error in result["errors"].values():
+            print(f"    Import error: {error}")
+        failed = failed or bool(result["queries"] or result["errors"])
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+import os
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import paramiko
+
+logger = logging.getLogger(__name__)
+
+# OpenSSH accepts 10 sessions per connection by default (MaxSessions), one of them is the main SFTP channel
+MAX_CHANNELS = 9
+
+
+class SftpTransfer:
+    """
+    One SSH connection shared by several SFTP channels, so many files can be sent or received concurrently
+    without opening a new connection per file. Remote directories are created once per transfer.
+
+    The same pool of threads, each with its own SFTP channel, is used by every upload and download until the
+    transfer is closed, so at most channels + 1 channels are open at once.
+    """
+
+    def __init__(self, host, port, user, password, channels=4):
+        self.ssh = paramiko.SSHClient()
+        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh.connect(host, int(port), user, password)
+        if int(channels) > MAX_CHANNELS:
+            logger.warning(f"{channels} SFTP channels requested, using {MAX_CHANNELS} (MaxSessions of the server)")
+        self.channels = max(1, min(int(channels), MAX_CHANNELS))
+        self._executor = None
+        self.sftp = self.ssh.open_sftp()
+        self._channel_clients = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Remote directories known to exist, and the ones created in this transfer (their children can not exist)
+        self._existing_dirs = set()
+        self._created_dirs = set()
+        # (operation, bytes, seconds) of every file sent or received
+        self.file_times = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        for client in self._channel_clients:
+            client.close()
+        self.sftp.close()
+        self.ssh.close()
+
+    @property
+    def executor(self):
+        # Worker threads of every transfer, created on first use
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.channels, thread_name_prefix="sftp")
+            return self._executor
+
+    def channel(self):
+        # One SFTP channel per worker thread, all of them over the same SSH transport
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = paramiko.SFTPClient.from_transport(self.ssh.get_transport())
+            self._local.client = client
+            with self._lock:
+                self._channel_clients.append(client)
+        return client
+
+    def makedirs(self, remote_dir):
+        if remote_dir in ("", os.sep) or remote_dir in self._existing_dirs:
+            return
+        parent_dir = os.path.dirname(remote_dir)
+        self.makedirs(parent_dir)
+
+        exists = False
+        if parent_dir not in self._created_dirs:
+            try:
+                self.sftp.stat(remote_dir)
+                exists = True
+            except FileNotFoundError:
+                pass
+
+        if not exists:
+            logger.info(f"Creating directory at [{remote_dir}]")
+            try:
+                self.sftp.mkdir(remote_dir)
+                self._created_dirs.add(remote_dir)
+            except IOError:
+                # Other tasks of the same run can be creating the same directory concurrently
+                self.sftp.stat(remote_dir)
+        self._existing_dirs.add(remote_dir)
+
+    def upload_files(self, files):
+        """files is a list of (local_path, remote_path)."""
+        # Directories are created up front so the concurrent uploads do not race for them
+        for remote_dir in sorted({os.path.dirname(remote_path) for _, remote_path in files}):
+            self.makedirs(remote_dir)
+        return self._transfer(files, "put")
+
+    def upload_tree(self, local_root, remote_root):
+        files = []
+        for root, dirs, filenames in os.walk(local_root):
+            remote_dir = os.path.join(remote_root, os.path.relpath(root, local_root))
+            self.makedirs(os.path.normpath(remote_dir))
+            for filename in filenames:
+                files.append((os.path.join(root, filename), os.path.normpath(os.path.join(remote_dir, filename))))
+        return self.upload_files(files)
+
+    def download_files(self, files):
+        """files is a list of (remote_path, local_path)."""
+        for local_dir in {os.path.dirname(local_path) for _, local_path in files}:
+            os.makedirs(local_dir or ".", exist_ok=True)
+        return self._transfer(files, "get")
+
+    def _transfer(self, files, operation):
+        start = time.perf_counter()
+        sizes = list(self.executor.map(lambda paths: self._transfer_file(operation, *paths), files))
+
+        elapsed = time.perf_counter() - start
+        total_bytes = sum(sizes)
+        logger.info(f"{'Sent' if operation == 'put' else 'Received'} {len(files)} files, {format_size(total_bytes)} "
+                    f"in {elapsed:.2f}s ({format_size(total_bytes / elapsed if elapsed else 0)}/s) "
+                    f"over {self.channels} SFTP channels")
+        return total_bytes
+
+    def _transfer_file(self, operation, source, destination):
+        start = time.perf_counter()
+        getattr(self.channel(), operation)(source, destination)
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(source if operation == "put" else destination)
+        with self._lock:
+            self.file_times.append((operation, size, elapsed))
+        logger.info(f"{'Sent' if operation == 'put' else 'Received'} [{source}] -> [{destination}] "
+                    f"{format_size(size)} in {elapsed:.2f}s ({format_size(size / elapsed if elapsed else 0)}/s)")
+        return size
+
+
+class StreamingUpload:
+    """
+    Uploads files to remote_root, keeping their path relative to local_root, while they are still being generated.
+    Every local file is deleted once it is on the server, so the local disk only holds the files waiting to be sent.
+    At most max_pending files wait to be sent: put blocks until there is room, so when the server is slower than
+    the export, the export waits for the uploads instead of filling the disk.
+    """
+
+    def __init__(self, transfer, local_root, remote_root, delete=True, max_pending=None):
+        self.transfer = transfer
+        self.local_root = os.path.abspath(local_root)
+        self.remote_root = remote_root
+        self.delete = delete
+        # Uploaded by the worker threads of the transfer, with their SFTP channels
+        self.futures = []
+        self._lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(max_pending or transfer.channels * 4)
+        self._start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def put(self, local_path):
+        relative_path = os.path.relpath(os.path.abspath(local_path), self.local_root)
+        remote_path = os.path.normpath(os.path.join(self.remote_root, relative_path))
+        self._pending.acquire()
+        try:
+            # Files are put from several threads, the directories are created through the shared SFTP channel
+            with self._lock:
+                self.transfer.makedirs(os.path.dirname(remote_path))
+                self.futures.append(self.transfer.executor.submit(self._upload, local_path, remote_path))
+        except Exception:
+            self._pending.release()
+            raise
+
+    def put_files(self, local_paths):
+        for local_path in local_paths:
+            self.put(local_path)
+
+    def _upload(self, local_path, remote_path):
+        try:
+            size = self.transfer._transfer_file("put", local_path, remote_path)
+            if self.delete:
+                os.remove(local_path)
+            return size
+        finally:
+            self._pending.release()
+
+    def close(self):
+        wait(self.futures)
+        # Raises the first upload error, if any
+        total_bytes = sum(future.result() for future in self.futures)
+        elapsed = time.perf_counter() - self._start
+        logger.info(f"Streamed {len(self.futures)} files, {format_size(total_bytes)} in {elapsed:.2f}s "
+                    f"over {self.transfer.channels} SFTP channels")
+        return total_bytes
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The DAGs import their modules from the dags directory, as Airflow does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,137 @@
+import os
+import threading
+
+import paramiko
+import pytest
+
+from sftp_transfer import SftpTransfer, StreamingUpload
+
+
+class FakeSftpServer:
+    """Remote directories and files of every fake SFTP channel, shared like on a real server."""
+
+    def __init__(self):
+        self.dirs = {"/"}
+        self.files = {}
+        self.mkdirs = []
+        # Directories another task creates between our stat and our mkdir
+        self.racing_dirs = set()
+        self.failing_files = set()
+        self.lock = threading.Lock()
+
+
+class FakeSftpClient:
+    def __init__(self, server):
+        self.server = server
+
+    def stat(self, path):
+        with self.server.lock:
+            if path not in self.server.dirs and path not in self.server.files:
+                raise FileNotFoundError(path)
+
+    def mkdir(self, path):
+        with self.server.lock:
+            self.server.mkdirs.append(path)
+            if path in self.server.racing_dirs:
+                self.server.dirs.add(path)
+                raise IOError(f"Failure: {path}")
+            if path in self.server.dirs or os.path.dirname(path) not in self.server.dirs:
+                raise IOError(f"Failure: {path}")
+            self.server.dirs.add(path)
+
+    def put(self, local_path, remote_path):
+        if os.path.basename(local_path) in self.server.failing_files:
+            raise IOError(f"Failure: {remote_path}")
+        with open(local_path, "rb") as file:
+            content = file.read()
+        with self.server.lock:
+            assert os.path.dirname(remote_path) in self.server.dirs
+            self.server.files[remote_path] = content
+
+    def close(self):
+        pass
+
+
+class FakeSshClient:
+    server = None
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, *args):
+        pass
+
+    def open_sftp(self):
+        return FakeSftpClient(self.server)
+
+    def get_transport(self):
+        return self.server
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeSftpServer()
+    monkeypatch.setattr(FakeSshClient, "server", server)
+    monkeypatch.setattr(paramiko, "SSHClient", FakeSshClient)
+    monkeypatch.setattr(paramiko.SFTPClient, "from_transport", staticmethod(FakeSftpClient))
+    return server
+
+
+def write_files(root, paths):
+    for path in paths:
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(root, path), "w", encoding="utf-8") as file:
+            file.write(path)
+
+
+def test_makedirs_creates_every_directory_once(server):
+    with SftpTransfer("host", 22, "user", "password") as transfer:
+        transfer.makedirs("/root/run/html/png")
+        transfer.makedirs("/root/run/html/pdf")
+        transfer.makedirs("/root/run/html/png")
+    assert sorted(server.mkdirs) == ["/root", "/root/run", "/root/run/html", "/root/run/html/pdf",
+                                     "/root/run/html/png"]
+
+
+def test_makedirs_tolerates_a_concurrent_mkdir(server):
+    server.dirs.add("/root")
+    server.racing_dirs.add("/root/run")
+    with SftpTransfer("host", 22, "user", "password") as transfer:
+        transfer.makedirs("/root/run/html")
+    assert server.mkdirs == ["/root/run", "/root/run/html"]
+    assert {"/root/run", "/root/run/html"} <= server.dirs
+
+
+def test_upload_tree_keeps_the_relative_paths(server, tmp_path):
+    paths = ["metrics.json", "html/MAD/a.html", "html/MAD/b.html", "png/MAD/a.png"]
+    write_files(tmp_path, paths)
+    with SftpTransfer("host", 22, "user", "password", channels=3) as transfer:
+        transfer.upload_tree(str(tmp_path), "/root/run")
+    assert server.files == {f"/root/run/{path}": path.encode() for path in paths}
+
+
+def test_streaming_upload_deletes_the_uploaded_files(server, tmp_path):
+    paths = [f"png/MAD/{index}.png" for index in range(20)] + ["pdf/MAD/0.pdf"]
+    write_files(tmp_path, paths)
+    with SftpTransfer("host", 22, "user", "password", channels=3) as transfer:
+        with StreamingUpload(transfer, str(tmp_path), "/root/run", max_pending=2) as upload:
+            upload.put_files([os.path.join(tmp_path, path) for path in paths])
+    assert server.files == {f"/root/run/{path}": path.encode() for path in paths}
+    assert not any(os.path.isfile(os.path.join(tmp_path, path)) for path in paths)
+
+
+def test_streaming_upload_raises_the_upload_error_on_close(server, tmp_path):
+    paths = [f"png/{index}.png" for index in range(5)]
+    write_files(tmp_path, paths)
+    server.failing_files.add("2.png")
+    with SftpTransfer("host", 22, "user", "password", channels=2) as transfer:
+        upload = StreamingUpload(transfer, str(tmp_path), "/root/run")
+        upload.put_files([os.path.join(tmp_path, path) for path in paths])
+        with pytest.raises(IOError, match="2.png"):
+            upload.close()
+    # The failed file is kept, the rest are on the server and deleted
+    assert sorted(os.listdir(tmp_path / "png")) == ["2.png"]
+    assert len(server.files) == 4